@@ -0,0 +1,111 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+cache_dir = os.environ.get('TEXTGLYPHS_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'textglyphs'))
+cache_size = int(os.environ.get('TEXTGLYPHS_CACHE_SIZE', 256 * 1024 * 1024))
+
+cache_lock = threading.Lock()
+# bytes of the entries, counted once from the directory and kept up to date
+# with what this process writes; replicas sharing the directory write too, so
+# the directory is counted again whenever the limit looks exceeded
+used = None
+
+
+def cache_key(text, *versions):
+    digest = hashlib.sha256(text.encode('utf-8'))
+    for version in versions:
+        digest.update(b'\0' + str(version).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def cache_path(key):
+    return os.path.join(cache_dir, key + '.store')
+
+
+def load(key):
+    if not cache_size:
+        return None
+
+    path = cache_path(key)
+    try:
+        with open(path, 'rb') as cached:
+            data = cached.read()
+        os.utime(path)
+    except OSError:
+        return None
+
+    return data
+
+
+def store(key, data):
+    if not cache_size:
+        return
+
+    global used
+    path = cache_path(key)
+
+    with cache_lock:
+        os.makedirs(cache_dir, exist_ok=True)
+        # a temporary file of its own for each writer, in any process
+        descriptor, temporary = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        with os.fdopen(descriptor, 'wb') as cached:
+            cached.write(data)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        os.replace(temporary, path)
+
+        if used is None:
+            evict()
+        else:
+            used += len(data) - replaced
+            if used > cache_size:
+                evict()
+
+
+def remove(key):
+    global used
+    path = cache_path(key)
+    with cache_lock:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        if used is not None:
+            used -= size
+
+
+def evict():
+    global used
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.store'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                # removed by another replica in the meantime
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+    # a tenth of the room is freed at once, so a full cache is not counted
+    # again on every store
+    total = sum(size for _, size, _ in entries)
+    if total <= cache_size:
+        used = total
+        return
+    for _, size, name in sorted(entries):
+        if total <= cache_size * 0.9:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+        total -= size
+
+    used = total
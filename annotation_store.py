@@ -0,0 +1,207 @@
+import io
+import sys
+from types import MappingProxyType
+
+import numpy as np
+
+# a finished analysis without its spaCy documents: the raw text, the character
+# range of every verse, and per layer the verse, character range and interned
+# label id of each annotation, already filtered for overlaps, with the label
+# counts of every verse and stanza; stores are shared by every session, so
+# they are frozen once built
+
+# what numpy and the mappings around an array add to its data, in bytes
+array_overhead = 400
+
+
+def compact(key, text, bounds, layers):
+    labels = {}
+    store = {'key': key, 'text': text,
+             'lines': np.array(bounds, dtype=np.int32).reshape(-1, 2),
+             'layers': {}}
+
+    for layer, verses in layers.items():
+        columns = ([], [], [], [])
+        for line, ents in enumerate(verses):
+            start = bounds[line][0]
+            for ent in ents:
+                columns[0].append(line)
+                columns[1].append(start + ent['start'])
+                columns[2].append(start + ent['end'])
+                columns[3].append(labels.setdefault(ent['label'], len(labels)))
+
+        store['layers'][layer] = {'verse': np.array(columns[0], dtype=np.int32),
+                                  'start': np.array(columns[1], dtype=np.int32),
+                                  'end': np.array(columns[2], dtype=np.int32),
+                                  'label': np.array(columns[3], dtype=np.uint16)}
+
+    store['labels'] = list(labels)
+    return freeze(store)
+
+
+def concatenate(key, stores):
+    # stores of consecutive parts of one text, like its stanzas; the empty
+    # verse after the last line break of a part is the first verse of the next
+    labels = {}
+    lines = []
+    layers = {}
+    offset = 0
+    verses = 0
+    for number, store in enumerate(stores):
+        bounds = store['lines']
+        if number < len(stores) - 1 and store['text'].endswith('\n'):
+            bounds = bounds[:-1]
+        lines.append(bounds + offset)
+
+        ids = np.array([labels.setdefault(label, len(labels)) for label in store['labels']],
+                       dtype=np.uint16)
+        for layer, spans in store['layers'].items():
+            columns = layers.setdefault(layer, {'verse': [], 'start': [], 'end': [],
+                                                'label': []})
+            columns['verse'].append(spans['verse'] + verses)
+            columns['start'].append(spans['start'] + offset)
+            columns['end'].append(spans['end'] + offset)
+            columns['label'].append(ids[spans['label']])
+
+        offset += len(store['text'])
+        verses += len(bounds)
+
+    return freeze({'key': key, 'text': ''.join(store['text'] for store in stores),
+                   'lines': np.concatenate(lines).astype(np.int32),
+                   'labels': list(labels),
+                   'layers': {layer: {column: np.concatenate(values).astype(
+                                          np.uint16 if column == 'label' else np.int32)
+                                      for column, values in columns.items()}
+                              for layer, columns in layers.items()}})
+
+
+def summarize(store):
+    # how often each label of a layer occurs in every verse and stanza, so
+    # counts for the widgets never go back over the spans; blank lines end a
+    # stanza and belong to it
+    lines = len(store['lines'])
+    blank = np.array([not store['text'][start:end].strip()
+                      for start, end in store['lines'].tolist()], dtype=bool)
+    opening = ~blank & np.concatenate([[True], blank[:-1]])
+    stanzas = np.maximum(np.cumsum(opening) - 1, 0).astype(np.int32)
+    store['stanzas'] = stanzas
+
+    store['histograms'] = {}
+    for layer, spans in store['layers'].items():
+        labels, columns = np.unique(spans['label'], return_inverse=True)
+        verses = np.zeros((lines, len(labels)), dtype=np.int32)
+        np.add.at(verses, (spans['verse'], columns.reshape(-1)), 1)
+        stanza_counts = np.zeros((int(stanzas[-1]) + 1 if lines else 0, len(labels)),
+                                 dtype=np.int32)
+        np.add.at(stanza_counts, stanzas, verses)
+        store['histograms'][layer] = {'labels': labels, 'verses': verses,
+                                      'stanzas': stanza_counts, 'total': verses.sum(axis=0)}
+
+
+def freeze(store):
+    summarize(store)
+    store['lines'].flags.writeable = False
+    store['stanzas'].flags.writeable = False
+    for columns in list(store['layers'].values()) + list(store['histograms'].values()):
+        for values in columns.values():
+            values.flags.writeable = False
+
+    store['labels'] = tuple(store['labels'])
+    for part in ('layers', 'histograms'):
+        store[part] = MappingProxyType({layer: MappingProxyType(columns)
+                                        for layer, columns in store[part].items()})
+    return MappingProxyType(store)
+
+
+def memory_size(store):
+    # estimated bytes held by a store, for the memory budget
+    arrays = [store['lines'], store['stanzas']]
+    for columns in list(store['layers'].values()) + list(store['histograms'].values()):
+        arrays.extend(values for values in columns.values() if isinstance(values, np.ndarray))
+
+    return (sys.getsizeof(store['text']) + sum(map(sys.getsizeof, store['labels'])) +
+            sum(values.nbytes + array_overhead for values in arrays))
+
+
+def layer_verses(store, layer, window=None):
+    text = store['text']
+    labels = store['labels']
+    spans = store['layers'][layer]
+    start, stop = window or (0, len(store['lines']))
+    lines = store['lines'][start:stop]
+
+    cuts = np.searchsorted(spans['verse'], np.arange(start, start + len(lines) + 1))
+    first, last = cuts[0], cuts[-1]
+    cuts = (cuts - first).tolist()
+    starts = spans['start'][first:last].tolist()
+    ends = spans['end'][first:last].tolist()
+    ids = spans['label'][first:last].tolist()
+
+    for line, (verse_start, verse_end) in enumerate(lines.tolist()):
+        yield {'text': text[verse_start:verse_end], 'title': None,
+               'ents': [{'start': starts[span] - verse_start,
+                         'end': ends[span] - verse_start,
+                         'label': labels[ids[span]]}
+                        for span in range(cuts[line], cuts[line + 1])]}
+
+
+def verse_counts(store, layer):
+    return store['histograms'][layer]['verses'].sum(axis=1)
+
+
+def label_counts(store, layer, window=None):
+    histogram = store['histograms'][layer]
+    if window is None:
+        counts = histogram['total']
+    else:
+        counts = histogram['verses'][window[0]:window[1]].sum(axis=0)
+
+    return {store['labels'][label]: count for label, count
+            in zip(histogram['labels'].tolist(), counts.tolist()) if count}
+
+
+def stanza_counts(store, layer):
+    histogram = store['histograms'][layer]
+    return ([store['labels'][label] for label in histogram['labels'].tolist()],
+            histogram['stanzas'])
+
+
+def to_bytes(store):
+    arrays = {'text': np.array(store['text']), 'lines': store['lines'],
+              'labels': np.array(store['labels'], dtype=str)}
+    for layer, spans in store['layers'].items():
+        for column, values in spans.items():
+            arrays[f'{layer}.{column}'] = values
+
+    data = io.BytesIO()
+    np.savez_compressed(data, **arrays)
+    return data.getvalue()
+
+
+def to_dict(store):
+    return {'key': store['key'], 'text': store['text'], 'lines': store['lines'].tolist(),
+            'labels': list(store['labels']),
+            'layers': {layer: {column: values.tolist() for column, values in spans.items()}
+                       for layer, spans in store['layers'].items()}}
+
+
+def from_dict(data):
+    types = {'verse': np.int32, 'start': np.int32, 'end': np.int32, 'label': np.uint16}
+    return freeze({'key': data['key'], 'text': data['text'],
+                   'lines': np.array(data['lines'], dtype=np.int32).reshape(-1, 2),
+                   'labels': data['labels'],
+                   'layers': {layer: {column: np.array(values, dtype=types[column])
+                                      for column, values in spans.items()}
+                              for layer, spans in data['layers'].items()}})
+
+
+def from_bytes(data, key):
+    with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+        store = {'key': key, 'text': str(arrays['text']), 'lines': arrays['lines'],
+                 'labels': arrays['labels'].tolist(), 'layers': {}}
+        for name in arrays.files:
+            if '.' in name:
+                layer, column = name.split('.')
+                store['layers'].setdefault(layer, {})[column] = arrays[name]
+
+    return freeze(store)
@@ -0,0 +1,135 @@
+import argparse
+import html
+import json
+import os
+import sys
+from urllib.parse import quote
+
+from language_processing import add_layers, excluded, layer_names, layer_verses, split_verses
+from models import pipeline
+from visualizers import renderers
+
+# the starting positions of the sidebar slider in main.py
+default_opacity = {'ner': 2, 'tenses': 2}
+
+page = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title></head>
+<body style="font-family: serif; background: #e2e8ed">{content}</body></html>
+"""
+
+
+def file_name(text_id):
+    # a single file or directory name per text: ids of texts in subdirectories
+    # keep their path, escaped, and nothing can point outside the output
+    # directory
+    name = quote(text_id, safe='')
+    return '%2E' + name[1:] if name.startswith('.') else name
+
+
+def read_texts(source):
+    if os.path.isdir(source):
+        for root, _, files in sorted(os.walk(source)):
+            for name in sorted(files):
+                if name.endswith('.txt'):
+                    path = os.path.join(root, name)
+                    with open(path, encoding='utf-8') as text:
+                        yield text.read(), os.path.relpath(path, source)
+        return
+
+    if source.endswith('.txt'):
+        with open(source, encoding='utf-8') as text:
+            yield text.read(), os.path.basename(source)
+        return
+
+    stream = sys.stdin if source == '-' else open(source, encoding='utf-8')
+    with stream:
+        for number, line in enumerate(stream):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                yield record, str(number)
+            else:
+                yield record['text'], str(record.get('id', number))
+
+
+def annotations(analysis, layers):
+    return {layer: [[line, ent['start'], ent['end'], ent['label']]
+                    for line, verse in enumerate(layer_verses(analysis, layer))
+                    for ent in verse['ents']]
+            for layer in layers}
+
+
+def write_html(directory, text_id, analysis, layers, opacity):
+    os.makedirs(directory, exist_ok=True)
+    for layer in layers:
+        path = os.path.join(directory, f'{file_name(text_id)}.{layer}.html')
+        content = renderers[layer](analysis, opacity.get(layer, 5))
+        with open(path, 'w', encoding='utf-8') as output:
+            output.write(page.format(title=html.escape(f'{text_id} - {layer}'),
+                                     content=content))
+
+
+def run(source, layers, output, html_dir=None, processes=1, batch_size=64, opacity=None):
+    opacity = dict(default_opacity, **(opacity or {}))
+    exclude = excluded(tuple(layers))
+    matched = [layer for layer in layers if layer != 'ner']
+    if exclude:
+        print(f'{len(exclude)} pipeline components not needed by these filters: '
+              f'{", ".join(exclude)}', file=sys.stderr)
+
+    with pipeline(exclude=exclude) as nlp:
+        docs = nlp.pipe(read_texts(source), as_tuples=True,
+                        batch_size=batch_size, n_process=processes)
+
+        written = set()
+        for doc, text_id in docs:
+            if html_dir and text_id in written:
+                raise ValueError(f'two texts have the id {text_id}, '
+                                 'which would overwrite each other\'s pages')
+            written.add(text_id)
+
+            analysis = split_verses(doc)
+            add_layers(analysis, matched)
+
+            if output:
+                output.write(json.dumps({'id': text_id,
+                                         'lines': len(analysis['lines']),
+                                         'layers': annotations(analysis, layers)}) + '\n')
+                output.flush()
+            if html_dir:
+                write_html(html_dir, text_id, analysis, layers, opacity)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Annotate a corpus of texts without the Streamlit interface.')
+    parser.add_argument('source', help='a .txt file, a directory of .txt files, a JSONL '
+                        'file of {"id", "text"} records, or - to read JSONL from stdin')
+    parser.add_argument('--filters', nargs='+', choices=layer_names, default=layer_names,
+                        help='annotation filters to run (default: all)')
+    parser.add_argument('--jsonl', default='-',
+                        help='where to write the JSONL annotations, - for stdout '
+                        'or an empty string to skip them')
+    parser.add_argument('--html', help='directory for one rendered HTML page per text and filter')
+    parser.add_argument('--opacity', type=int, help='annotation presence for the HTML pages, 0 to 10')
+    parser.add_argument('--processes', type=int, default=1, help='number of parsing processes')
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args(argv)
+
+    opacity = {layer: args.opacity for layer in layer_names} if args.opacity is not None else None
+
+    if args.jsonl == '-':
+        run(args.source, args.filters, sys.stdout, args.html, args.processes,
+            args.batch_size, opacity)
+    elif args.jsonl:
+        with open(args.jsonl, 'w', encoding='utf-8') as output:
+            run(args.source, args.filters, output, args.html, args.processes,
+                args.batch_size, opacity)
+    else:
+        run(args.source, args.filters, None, args.html, args.processes,
+            args.batch_size, opacity)
+
+
+if __name__ == '__main__':
+    main()
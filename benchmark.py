@@ -0,0 +1,260 @@
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from random import Random
+
+import spacy
+
+import annotation_cache
+import language_processing
+import memory_cache
+import models
+import visualizers
+
+# words the synthetic verses are built from, with the tags the stand-in
+# pipeline gives them so every filter has something to annotate
+vocabulary = {
+    'noun': {'bee': 'Number=Sing', 'rose': 'Number=Sing', 'hill': 'Number=Sing',
+             'sea': 'Number=Sing', 'door': 'Number=Sing', 'light': 'Number=Sing',
+             'birds': 'Number=Plur', 'leaves': 'Number=Plur', 'stars': 'Number=Plur',
+             'graves': 'Number=Plur'},
+    'adjective': {'happy': 'Degree=Pos', 'dreadful': 'Degree=Pos', 'quiet': 'Degree=Pos',
+                  'bright': 'Degree=Pos', 'sad': 'Degree=Pos', 'good': 'Degree=Pos'},
+    'past': {'fell': 'Tense=Past|VerbForm=Fin', 'heard': 'Tense=Past|VerbForm=Fin',
+             'kissed': 'Tense=Past|VerbForm=Fin', 'went': 'Tense=Past|VerbForm=Fin'},
+    'present': {'sings': 'Number=Sing|Person=3|Tense=Pres|VerbForm=Fin',
+                'waits': 'Number=Sing|Person=3|Tense=Pres|VerbForm=Fin',
+                'hides': 'Number=Sing|Person=3|Tense=Pres|VerbForm=Fin'},
+    'infinitive': {'see': 'VerbForm=Inf', 'keep': 'VerbForm=Inf', 'die': 'VerbForm=Inf'},
+    'pronoun': {'i': 'Case=Nom|Number=Sing|Person=1|PronType=Prs',
+                'we': 'Case=Nom|Number=Plur|Person=1|PronType=Prs',
+                'she': 'Case=Nom|Gender=Fem|Number=Sing|Person=3|PronType=Prs',
+                'they': 'Case=Nom|Number=Plur|Person=3|PronType=Prs'},
+    'name': {'Emily': '', 'Amherst': ''},
+    'number': {'two': 'NumType=Card', 'seven': 'NumType=Card', 'one': 'NumType=Card'},
+}
+
+patterns = ['The {adjective} {noun} {past} upon the {noun} -',
+            'And {pronoun} {present} the {adjective} {noun},',
+            '{number} {noun} {past} to {infinitive} the {noun}',
+            'Then {name} {past} a {adjective} {noun} -',
+            'Not {pronoun} - who {past} the {number} {noun} -',
+            'How {adjective} the {noun} {present}!']
+
+pos_tags = {'noun': 'NOUN', 'adjective': 'ADJ', 'past': 'VERB', 'present': 'VERB',
+            'infinitive': 'VERB', 'pronoun': 'PRON', 'name': 'PROPN', 'number': 'NUM'}
+function_words = {'the': 'DET', 'a': 'DET', 'upon': 'ADP', 'to': 'PART', 'and': 'CCONJ',
+                  'then': 'ADV', 'not': 'PART', 'who': 'PRON', 'how': 'SCONJ',
+                  '-': 'PUNCT', ',': 'PUNCT', '!': 'PUNCT'}
+
+sizes = {'stanza': 4, 'poem': 24, 'chapbook': 240, 'book': 2400}
+
+
+def synthetic_text(lines, seed=0):
+    random = Random(seed)
+    verses = []
+    for line in range(lines):
+        if line and line % 4 == 0:
+            verses.append('')
+        verse = random.choice(patterns).format(**{kind: random.choice(list(words))
+                                                  for kind, words in vocabulary.items()})
+        verses.append(verse[0].upper() + verse[1:])
+
+    return '\n'.join(verses)
+
+
+def tiny_pipeline():
+    nlp = spacy.blank('en')
+    nlp.meta.update({'name': 'tiny', 'version': '0.0.0'})
+
+    ruler = nlp.add_pipe('attribute_ruler')
+    ruler.add([[{}]], {'POS': 'X'})
+    ruler.add([[{'IS_SPACE': True}]], {'POS': 'SPACE'})
+    for word, pos in function_words.items():
+        ruler.add([[{'LOWER': word}]], {'POS': pos})
+    for kind, words in vocabulary.items():
+        for word, morph in words.items():
+            attributes = {'POS': pos_tags[kind]}
+            if morph:
+                attributes['MORPH'] = morph
+            ruler.add([[{'LOWER': word.lower()}]], attributes)
+
+    nlp.add_pipe('sentencizer')
+    entities = nlp.add_pipe('entity_ruler', name='ner')
+    entities.add_patterns([{'label': 'PERSON', 'pattern': 'Emily'},
+                           {'label': 'GPE', 'pattern': 'Amherst'}] +
+                          [{'label': 'CARDINAL', 'pattern': [{'LOWER': number}]}
+                           for number in vocabulary['number']])
+
+    return nlp
+
+
+class Capture:
+    # stands in for the streamlit module, keeping only the size of the output
+    def __init__(self):
+        self.sidebar = self
+        self.written = 0
+
+    def write(self, body, **kwargs):
+        self.written += len(str(body))
+
+    def selectbox(self, label, options, format_func=str, **kwargs):
+        options = list(options)
+        for option in options:
+            format_func(option)
+        return options[0]
+
+    def checkbox(self, label, value=False, **kwargs):
+        return value
+
+    def multiselect(self, label, options, default=None, **kwargs):
+        return default or []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+detectors = {layer: getattr(language_processing, f'detect_{layer}')
+             for layer in language_processing.layer_names}
+
+displays = {'ner': lambda analysis: visualizers.display_ner(analysis, 2),
+            'pos': lambda analysis: visualizers.display_pos(analysis, 'pattern', 5),
+            'pos search': lambda analysis: visualizers.display_pos(analysis, 'search', 5),
+            'quantity': lambda analysis: visualizers.display_quantity(analysis, 5),
+            'persons': lambda analysis: visualizers.display_persons(analysis, 5),
+            'tenses': lambda analysis: visualizers.display_tenses(analysis, 2),
+            'sentiments': lambda analysis: visualizers.display_sentiments(analysis, 5),
+            'subjectivity': lambda analysis: visualizers.display_subjectivity(analysis, 5)}
+
+
+def forget_renders():
+    memory_cache.clear('render', 'segments', 'pages')
+    visualizers.entity_template.cache_clear()
+
+
+def forget_analyses():
+    memory_cache.clear()
+    visualizers.entity_template.cache_clear()
+
+
+def cases(text):
+    for layer, detect in detectors.items():
+        yield f'detect_{layer}', forget_analyses, lambda detect=detect: detect(text)
+
+    yield 'analyze (all filters)', forget_analyses, lambda: language_processing.analyze(text)
+
+    def analyzed():
+        forget_renders()
+        language_processing.analyze(text)
+
+    for name, display in displays.items():
+        yield (f'display_{name}', analyzed,
+               lambda display=display: display(language_processing.analyze(text)))
+
+
+def measure(setup, run, repeat):
+    seconds = []
+    for _ in range(repeat):
+        setup()
+        parses = models.stats['parses']
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+        parses = models.stats['parses'] - parses
+
+    setup()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(seconds), parses, peak
+
+
+def run(size_names, repeat):
+    models.load_model(exclude=language_processing.excluded())
+    language_processing.analyze(synthetic_text(1))
+
+    results = []
+    for size in size_names:
+        lines = sizes[size]
+        text = synthetic_text(lines)
+        for name, setup, call in cases(text):
+            seconds, parses, peak = measure(setup, call, repeat)
+            result = {'case': name, 'size': size, 'lines': lines, 'seconds': seconds,
+                      'parses': parses, 'peak': peak, 'per_line': seconds / lines}
+            results.append(result)
+            yield result
+
+
+def compare(result, baseline, tolerance):
+    previous = baseline.get((result['case'], result['size']))
+    if not previous or not previous['seconds']:
+        return '', False
+
+    ratio = result['seconds'] / previous['seconds']
+    return f'{ratio:6.2f}x', ratio > 1 + tolerance
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the detect_* and display_* functions over synthetic texts.')
+    parser.add_argument('--sizes', nargs='+', choices=sizes, default=list(sizes),
+                        help='text sizes to run (default: all)')
+    parser.add_argument('--pipeline', choices=['model', 'tiny'], default='model',
+                        help='the configured spaCy model, or a rule based stand-in '
+                        'for fast timing')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per case, the fastest one is reported')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown against the baseline reported as a regression')
+    args = parser.parse_args(argv)
+
+    # every case starts cold, so nothing may come back from the disk cache
+    annotation_cache.cache_size = 0
+    visualizers.st = Capture()
+    if args.pipeline == 'tiny':
+        models.register_model(tiny_pipeline())
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as saved:
+            baseline = {(result['case'], result['size']): result
+                        for result in json.load(saved)['results']}
+
+    print(f'{"case":<24}{"size":<10}{"lines":>6}{"ms":>10}{"parses":>8}'
+          f'{"peak KiB":>10}{"us/line":>10}{"baseline":>10}')
+
+    results = []
+    regressions = 0
+    for result in run(args.sizes, args.repeat):
+        results.append(result)
+        ratio, regressed = compare(result, baseline, args.tolerance)
+        regressions += regressed
+        print(f'{result["case"]:<24}{result["size"]:<10}{result["lines"]:>6}'
+              f'{result["seconds"] * 1000:>10.1f}{result["parses"]:>8}'
+              f'{result["peak"] / 1024:>10.0f}{result["per_line"] * 1e6:>10.1f}'
+              f'{ratio:>10}{" !" if regressed else ""}')
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as saved:
+            json.dump({'pipeline': args.pipeline, 'model': models.default_model,
+                       'model_version': models.model_version(), 'results': results},
+                      saved, indent=1)
+
+    if regressions:
+        print(f'{regressions} case(s) slower than the baseline by more than '
+              f'{args.tolerance:.0%}', file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
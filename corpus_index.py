@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import numpy as np
+
+import annotation_store
+import memory_cache
+from batch import read_texts
+from language_processing import analyze_batch, layer_names
+
+# every verse of the corpus is one 64 bit key, the text number in the high
+# half and the line number in the low one, and each label of each layer has
+# the sorted keys of the verses it occurs in; postings are stored as the
+# differences between neighbours, which compress to almost nothing
+index_dir = os.environ.get('TEXTGLYPHS_INDEX')
+ranges = ['polarity', 'stanza_polarity']
+line_bits = np.uint64(32)
+
+loaded = {}
+loaded_lock = threading.Lock()
+
+
+def verse_keys(number, lines):
+    return (np.uint64(number) << line_bits) | lines.astype(np.uint64)
+
+
+def polarities(store):
+    # the mean sentiment score of the verses, and of the stanzas they are in
+    histogram = store['histograms']['sentiments']
+    scores = np.array([float(store['labels'][label]) for label in histogram['labels'].tolist()])
+    blank = np.array([not store['text'][start:end].strip()
+                      for start, end in store['lines'].tolist()], dtype=bool)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        polarity = histogram['verses'] @ scores / histogram['verses'].sum(axis=1)
+        stanza_polarity = histogram['stanzas'] @ scores / histogram['stanzas'].sum(axis=1)
+    return (~blank, polarity, stanza_polarity[store['stanzas']])
+
+
+def build(source, directory, batch_size=64):
+    os.makedirs(os.path.join(directory, 'texts'), exist_ok=True)
+
+    texts = list(read_texts(source))
+    ids = []
+    postings = {}
+    columns = {'keys': [], 'polarity': [], 'stanza_polarity': []}
+
+    for start in range(0, len(texts), batch_size):
+        chunk = texts[start:start + batch_size]
+        stores = analyze_batch([text for text, _ in chunk], layer_names, batch_size)
+
+        for (_, text_id), store in zip(chunk, stores):
+            number = len(ids)
+            ids.append(text_id)
+            with open(os.path.join(directory, 'texts', f'{number}.store'), 'wb') as output:
+                output.write(annotation_store.to_bytes(store))
+
+            verses, polarity, stanza_polarity = polarities(store)
+            columns['keys'].append(verse_keys(number, np.flatnonzero(verses)))
+            columns['polarity'].append(polarity[verses])
+            columns['stanza_polarity'].append(stanza_polarity[verses])
+
+            for layer in layer_names:
+                spans = store['layers'][layer]
+                for label in np.unique(spans['label']).tolist():
+                    lines = np.unique(spans['verse'][spans['label'] == label])
+                    term = f'{layer}:{store["labels"][label]}'
+                    postings.setdefault(term, []).append(verse_keys(number, lines))
+
+    terms = sorted(postings)
+    keys = [np.concatenate(postings[term]) for term in terms]
+    offsets = np.cumsum([0] + [len(posting) for posting in keys])
+    deltas = np.concatenate([np.diff(posting, prepend=np.uint64(0)) for posting in keys]
+                            or [np.zeros(0, dtype=np.uint64)])
+
+    np.savez_compressed(os.path.join(directory, 'index.npz'), deltas=deltas, offsets=offsets,
+                        **{name: np.concatenate(values or [np.zeros(0)])
+                           for name, values in columns.items()})
+    with open(os.path.join(directory, 'index.json'), 'w', encoding='utf-8') as output:
+        json.dump({'ids': ids, 'terms': terms}, output)
+
+    return {'texts': len(ids), 'terms': len(terms), 'postings': len(deltas)}
+
+
+def load_index(directory=None):
+    directory = directory or index_dir
+    with loaded_lock:
+        if directory not in loaded:
+            with open(os.path.join(directory, 'index.json'), encoding='utf-8') as saved:
+                index = json.load(saved)
+            with np.load(os.path.join(directory, 'index.npz')) as arrays:
+                index.update({name: arrays[name] for name in arrays.files})
+
+            index['directory'] = directory
+            index['term_numbers'] = {term.upper(): number
+                                     for number, term in enumerate(index['terms'])}
+            index['keys'] = index['keys'].astype(np.uint64)
+            index['postings'] = {}
+            loaded[directory] = index
+
+        return loaded[directory]
+
+
+def posting(index, term):
+    number = index['term_numbers'].get(term.upper())
+    if number is None:
+        return np.zeros(0, dtype=np.uint64)
+
+    with loaded_lock:
+        if number not in index['postings']:
+            start, end = index['offsets'][number:number + 2]
+            index['postings'][number] = np.cumsum(index['deltas'][start:end], dtype=np.uint64)
+
+        return index['postings'][number]
+
+
+token_pattern = re.compile(r'\s*(?:(\(|\))|(AND|OR|NOT)\b|(\w+)\s*(<=|>=|<|>)\s*(-?[\d.]+)'
+                           r'|(\w+):(?:"([^"]*)"|([^\s()"]+)))')
+comparisons = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal}
+
+
+def tokenize(query):
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = token_pattern.match(query, position)
+        if match is None or match.end() == position:
+            raise ValueError(f'cannot read the query from "{query[position:]}"')
+        bracket, operator, field, comparison, value, layer, quoted, label = match.groups()
+        if bracket or operator:
+            tokens.append(bracket or operator)
+        elif field:
+            if field not in ranges:
+                raise ValueError(f'unknown range "{field}", use one of {", ".join(ranges)}')
+            tokens.append(('range', field, comparison, float(value)))
+        else:
+            if layer not in layer_names:
+                raise ValueError(f'unknown layer "{layer}", use one of {", ".join(layer_names)}')
+            tokens.append(('term', f'{layer}:{quoted if quoted is not None else label}'))
+        position = match.end()
+
+    return tokens
+
+
+def evaluate(index, tokens):
+    # OR binds loosest, then AND, which can be left out between terms, then NOT
+    def union(position):
+        keys, position = intersection(position)
+        while position < len(tokens) and tokens[position] == 'OR':
+            other, position = intersection(position + 1)
+            keys = np.union1d(keys, other)
+        return keys, position
+
+    def intersection(position):
+        keys, position = negation(position)
+        while position < len(tokens) and tokens[position] not in ('OR', ')'):
+            if tokens[position] == 'AND':
+                position += 1
+            other, position = negation(position)
+            keys = np.intersect1d(keys, other, assume_unique=True)
+        return keys, position
+
+    def negation(position):
+        if position >= len(tokens):
+            raise ValueError('the query ends too early')
+        token = tokens[position]
+        if token == 'NOT':
+            keys, position = negation(position + 1)
+            return np.setdiff1d(index['keys'], keys, assume_unique=True), position
+        if token == '(':
+            keys, position = union(position + 1)
+            if position >= len(tokens) or tokens[position] != ')':
+                raise ValueError('a bracket is not closed')
+            return keys, position + 1
+        if isinstance(token, tuple) and token[0] == 'term':
+            return posting(index, token[1]), position + 1
+        if isinstance(token, tuple) and token[0] == 'range':
+            _, field, comparison, value = token
+            return index['keys'][comparisons[comparison](index[field], value)], position + 1
+        raise ValueError(f'unexpected "{token}"')
+
+    keys, position = union(0)
+    if position < len(tokens):
+        raise ValueError(f'unexpected "{tokens[position]}"')
+    return keys
+
+
+def query_layer(tokens):
+    # hits are shown with the filter of the first layer the query names
+    for token in tokens:
+        if isinstance(token, tuple) and token[0] == 'term':
+            return token[1].split(':')[0]
+    return 'sentiments'
+
+
+def load_store(index, number):
+    key = ('corpus', index['directory'], number)
+    store = memory_cache.get(key)
+    if store is None:
+        path = os.path.join(index['directory'], 'texts', f'{number}.store')
+        # without a key the verses of hits are rendered on the spot rather
+        # than pushing whole poems out of the memory budget
+        with open(path, 'rb') as saved:
+            store = annotation_store.from_bytes(saved.read(), None)
+        memory_cache.put(key, store, annotation_store.memory_size(store))
+
+    return store
+
+
+def search(query, limit=50, directory=None):
+    index = load_index(directory)
+    tokens = tokenize(query)
+    keys = evaluate(index, tokens)
+
+    hits = []
+    for key in keys[:limit].tolist():
+        number, line = key >> 32, key & 0xFFFFFFFF
+        if not hits or hits[-1]['number'] != number:
+            hits.append({'number': number, 'id': index['ids'][number],
+                         'store': load_store(index, number), 'lines': []})
+        hits[-1]['lines'].append(line)
+
+    return {'layer': query_layer(tokens), 'count': len(keys), 'texts': hits}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Build an index of the annotations of a corpus, or query it.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    building = commands.add_parser('build', help='analyze a corpus and write its index')
+    building.add_argument('source', help='a .txt file, a directory of .txt files, a JSONL '
+                          'file of {"id", "text"} records, or - to read JSONL from stdin')
+    building.add_argument('index', help='directory for the index')
+    building.add_argument('--batch-size', type=int, default=64)
+    querying = commands.add_parser(
+        'query', help='print the verses matching a query such as '
+        '\'tenses:PAST AND persons:"2 SING"\' or \'stanza_polarity < -0.3\'')
+    querying.add_argument('index', help='directory of the index')
+    querying.add_argument('query')
+    querying.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        print(json.dumps(build(args.source, args.index, args.batch_size)))
+        return 0
+
+    start = time.perf_counter()
+    try:
+        results = search(args.query, args.limit, args.index)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 2
+
+    for hit in results['texts']:
+        store = hit['store']
+        for line in hit['lines']:
+            start_char, end_char = store['lines'][line].tolist()
+            print(f'{hit["id"]}:{line + 1}\t{store["text"][start_char:end_char].strip()}')
+    print(f'{results["count"]} verses in {(time.perf_counter() - start) * 1000:.1f} ms',
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
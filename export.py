@@ -0,0 +1,150 @@
+import argparse
+import hashlib
+import html
+import json
+import os
+import threading
+from collections import Counter
+
+import annotation_store
+import instrumentation
+import memory_cache
+import store_backend
+from batch import file_name, page, read_texts, renderers
+from language_processing import analyze, analyze_batch, layer_names
+
+# the positions of the sidebar slider in main.py that get a page of their
+# own: its start, and a subtler and a more vivid reading
+presets = {'ner': [1, 2, 3], 'tenses': [1, 2, 3]}
+default_presets = [2, 5, 8]
+
+# main.py shows the bundles in this directory instead of analyzing them
+bundle_dir = os.environ.get('TEXTGLYPHS_BUNDLES')
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def bundle_pages(store, text_id, layers):
+    for layer in layers:
+        for opacity in presets.get(layer, default_presets):
+            content = renderers[layer](store, opacity)
+            yield (f'{layer}-{opacity}.html',
+                   page.format(title=html.escape(f'{text_id} - {layer}'), content=content))
+
+
+def index_page(text_id, names):
+    links = '\n'.join(f'<li><a href="{name}">{html.escape(name[:-5])}</a></li>'
+                      for name in names)
+    return page.format(title=html.escape(text_id), content=f'<ul>\n{links}\n</ul>')
+
+
+def write_bundle(directory, text_id, text, store, layers):
+    bundle = os.path.join(directory, file_name(text_id))
+    os.makedirs(bundle, exist_ok=True)
+
+    names = []
+    for name, content in bundle_pages(store, text_id, layers):
+        with open(os.path.join(bundle, name), 'w', encoding='utf-8') as output:
+            output.write(content)
+        names.append(name)
+
+    with open(os.path.join(bundle, 'index.html'), 'w', encoding='utf-8') as output:
+        output.write(index_page(text_id, names))
+    with open(os.path.join(bundle, 'annotations.json'), 'w', encoding='utf-8') as output:
+        json.dump(dict(annotation_store.to_dict(store), id=text_id), output)
+
+    return {'id': text_id, 'title': text.strip().split('\n')[0][:80],
+            'hash': text_hash(text), 'pages': names}
+
+
+def export(source, directory, layers=layer_names, batch_size=64):
+    texts = [(text, text_id[:-4] if text_id.endswith('.txt') else text_id)
+             for text, text_id in read_texts(source)]
+    repeated = [text_id for text_id, count in Counter(text_id for _, text_id in texts).items()
+                if count > 1]
+    if repeated:
+        raise ValueError(f'texts share the ids {", ".join(repeated[:5])}, '
+                         'which would overwrite each other\'s bundles')
+
+    bundles = []
+    for start in range(0, len(texts), batch_size):
+        chunk = texts[start:start + batch_size]
+        stores = analyze_batch([text for text, _ in chunk], layer_names, batch_size)
+        for (text, text_id), store in zip(chunk, stores):
+            bundles.append(write_bundle(directory, text_id, text, store, layers))
+
+    with open(os.path.join(directory, 'bundles.json'), 'w', encoding='utf-8') as output:
+        json.dump(bundles, output, indent=1)
+
+    return bundles
+
+
+# the viewer side, the functions main.py calls on its backend; bundled texts
+# are read from their annotations, anything else is analyzed
+index = {}
+loaded_lock = threading.Lock()
+
+
+def bundle_index():
+    with loaded_lock:
+        if not index:
+            with open(os.path.join(bundle_dir, 'bundles.json'), encoding='utf-8') as saved:
+                index.update((bundle['hash'], bundle) for bundle in json.load(saved))
+
+        return index
+
+
+def load_bundle(text_id):
+    store = memory_cache.get(('bundle', text_id))
+    if store is None:
+        path = os.path.join(bundle_dir, file_name(text_id), 'annotations.json')
+        with open(path, encoding='utf-8') as saved:
+            store = annotation_store.from_dict(json.load(saved))
+        memory_cache.put(('bundle', text_id), store, annotation_store.memory_size(store))
+
+    return store
+
+
+def view(text, per_line=False):
+    bundle = None if per_line else bundle_index().get(text_hash(text))
+    if bundle is None:
+        return analyze(text, per_line=per_line)
+
+    instrumentation.count('bundle hits')
+    return load_bundle(bundle['id'])
+
+
+viewer = store_backend.build(view)
+prefetch = viewer['prefetch']
+cancel_prefetch = viewer['cancel_prefetch']
+reanalyze = viewer['reanalyze']
+detect_ner = viewer['detect_ner']
+detect_pos = viewer['detect_pos']
+detect_quantity = viewer['detect_quantity']
+detect_persons = viewer['detect_persons']
+detect_tenses = viewer['detect_tenses']
+detect_sentiments = viewer['detect_sentiments']
+detect_subjectivity = viewer['detect_subjectivity']
+detect_summary = viewer['detect_summary']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Write a static bundle per text: one HTML page per filter and '
+        'opacity preset, and the annotations as JSON.')
+    parser.add_argument('source', help='a .txt file, a directory of .txt files, a JSONL '
+                        'file of {"id", "text"} records, or - to read JSONL from stdin')
+    parser.add_argument('output', help='directory for the bundles')
+    parser.add_argument('--filters', nargs='+', choices=layer_names, default=layer_names,
+                        help='filters to render pages for (default: all)')
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args(argv)
+
+    for bundle in export(args.source, args.output, args.filters, args.batch_size):
+        print(f'{bundle["id"]}: {len(bundle["pages"])} pages')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+# opt-in for every session with the environment, or per session with ?debug=1
+# in the page address; the metrics file gets one JSON line per script run
+enabled = bool(os.environ.get('TEXTGLYPHS_DEBUG'))
+metrics_file = os.environ.get('TEXTGLYPHS_METRICS_FILE')
+
+# a run belongs to the thread executing the Streamlit script, so prefetch
+# threads and other sessions never record into it
+local = threading.local()
+nothing = nullcontext()
+metrics_lock = threading.Lock()
+
+# the first script run of a process imports this module, so cold start
+# durations are measured from here
+started = time.perf_counter()
+startup = {}
+
+# state of the whole process reported with every run, by name
+watched = {}
+
+
+class Stage:
+    def __init__(self, run, name):
+        self.run = run
+        self.name = name
+
+    def __enter__(self):
+        self.record = [self.name, self.run['depth'], 0.0]
+        self.run['stages'].append(self.record)
+        self.run['depth'] += 1
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exception):
+        self.record[2] = time.perf_counter() - self.start
+        self.run['depth'] -= 1
+
+
+def current():
+    return getattr(local, 'run', None)
+
+
+def stage(name):
+    run = current()
+    return nothing if run is None else Stage(run, name)
+
+
+def timed(function):
+    name = function.__name__
+
+    @wraps(function)
+    def recorded(*args, **kwargs):
+        run = current()
+        if run is None:
+            return function(*args, **kwargs)
+        with Stage(run, name):
+            return function(*args, **kwargs)
+
+    return recorded
+
+
+def record(name, seconds):
+    run = current()
+    if run is not None:
+        run['stages'].append([name, run['depth'], seconds])
+
+
+@contextmanager
+def recording(run):
+    # lets a worker thread record into the run of the session waiting for it
+    previous = current()
+    local.run = run
+    try:
+        yield
+    finally:
+        local.run = previous
+
+
+def count(name, amount=1):
+    run = current()
+    if run is not None:
+        run['counters'][name] += amount
+
+
+def note(**sizes):
+    run = current()
+    if run is not None:
+        run['sizes'].update(sizes)
+
+
+def start_run(**context):
+    local.run = {'context': context, 'stages': [], 'depth': 0, 'counters': Counter(),
+                 'sizes': {}, 'start': time.perf_counter()}
+
+
+def finish_run():
+    run = current()
+    local.run = None
+    if run is None:
+        return None
+
+    metrics = {'time': time.time(),
+               'context': run['context'],
+               'total': time.perf_counter() - run['start'],
+               'stages': [{'stage': name, 'depth': depth, 'seconds': seconds}
+                          for name, depth, seconds in run['stages']],
+               'counters': dict(run['counters']),
+               'sizes': run['sizes'],
+               'startup': startup,
+               'process': {name: read() for name, read in watched.items()}}
+
+    if metrics_file:
+        with metrics_lock, open(metrics_file, 'a', encoding='utf-8') as output:
+            output.write(json.dumps(metrics) + '\n')
+
+    return metrics
+
+
+def watch(name, read):
+    watched[name] = read
+
+
+def report_startup(**seconds):
+    if startup:
+        return
+
+    startup.update(seconds, first_page=time.perf_counter() - started)
+    print('cold start: ' + ', '.join(f'{stage} {duration:.2f}s'
+                                     for stage, duration in startup.items()),
+          file=sys.stderr, flush=True)
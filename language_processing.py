@@ -1,204 +1,572 @@
-import streamlit as st
-import spacy
-from spacy.matcher import Matcher, PhraseMatcher
-from spacy.tokens import Span
-from spacytextblob.spacytextblob import SpacyTextBlob
-
-detect_model = 'en_core_web_sm'
-
-@st.cache(allow_output_mutation=True)
-def detect_ner(text):
-    ner_nlp = spacy.load(detect_model)
-    full_text = ner_nlp(text)
-    verses = [ner_nlp(verse) for verse in text.split('\n')]
-    return {'text': full_text, 'lines': verses}
+import re
+import threading
+import zipfile
+from bisect import bisect_right
+from collections import Counter
+from functools import lru_cache
+from difflib import SequenceMatcher
+from itertools import islice
+import numpy as np
+from spacy.attrs import MORPH, POS
+from spacy.matcher import Matcher
+from spacy.symbols import VERB
+from spacy.tokens import Doc, Span
+from spacy.util import filter_spans
+import annotation_cache
+import annotation_store
+import instrumentation
+import memory_cache
+import sentiment
+import workers
+from models import default_model, model_version, pipeline, plan
 
+# bump when the way layers are derived changes, to invalidate cached results
+filter_version = 5
 
-@st.cache(allow_output_mutation=True)
-def detect_pos(text):
-    pos_nlp = spacy.load(detect_model, disable=["ner"])
-    full_text = pos_nlp(text)
-    verses = [pos_nlp(verse) for verse in text.split('\n')]
-
-    patterns = [
-        [{'POS': 'ADJ'}],
-        [{'POS': 'ADP'}],
-        [{'POS': 'ADV'}],
-        [{'POS': 'AUX'}],
-        [{'POS': 'CONJ'}],
-        [{'POS': 'DET'}],
-        [{'POS': 'INTJ'}],
-        [{'POS': 'NOUN'}],
-        [{'POS': 'NUM'}],
-        [{'POS': 'PART'}],
-        [{'POS': 'PRON'}],
-        [{'POS': 'PROPN'}],
-        [{'POS': 'PUNCT'}],
-        [{'POS': 'SYM'}],
-        [{'POS': 'VERB'}],
-        [{'POS': 'X'}],
-        [{'POS': 'SPACE'}],
-        [{'POS': 'CCONJ'}],
-        [{'POS': 'SCONJ'}]
-    ]
-
-    matcher = Matcher(pos_nlp.vocab)
-    for pattern in patterns:
-        matcher.add(key=pattern[0]['POS'], patterns=[pattern])
+pos_patterns = [
+    [{'POS': 'ADJ'}],
+    [{'POS': 'ADP'}],
+    [{'POS': 'ADV'}],
+    [{'POS': 'AUX'}],
+    [{'POS': 'CONJ'}],
+    [{'POS': 'DET'}],
+    [{'POS': 'INTJ'}],
+    [{'POS': 'NOUN'}],
+    [{'POS': 'NUM'}],
+    [{'POS': 'PART'}],
+    [{'POS': 'PRON'}],
+    [{'POS': 'PROPN'}],
+    [{'POS': 'PUNCT'}],
+    [{'POS': 'SYM'}],
+    [{'POS': 'VERB'}],
+    [{'POS': 'X'}],
+    [{'POS': 'SPACE'}],
+    [{'POS': 'CCONJ'}],
+    [{'POS': 'SCONJ'}]
+]
 
-    for verse in verses:
-        matches = matcher(verse)
-        for id, start, end in matches:
-            new_ent = Span(verse, start, end, label=id)
-            verse.ents = list(verse.ents) + [new_ent]
-            
-    matches = matcher(full_text)
-    for id, start, end in matches:
-        new_ent = Span(full_text, start, end, label=id)
-        full_text.ents = list(full_text.ents) + [new_ent]
+text_to_num = {'first': '1', 'second': '2', 'third': '3',
+               'one': '1', 'two': '2', 'three': '3'}
 
-    return {'text': full_text, 'lines': verses}
 
+def pos_matcher(vocab, full_text):
+    matcher = Matcher(vocab)
+    for pattern in pos_patterns:
+        matcher.add(key=pattern[0]['POS'], patterns=[pattern])
 
-@st.cache(allow_output_mutation=True)        
-def detect_quantity(text):
-    
-    quantity_nlp = spacy.load(detect_model, disable=["ner"])
-    full_text = quantity_nlp(text)
-    verses = [quantity_nlp(verse) for verse in text.split('\n')]
+    return matcher
 
-    matcher = Matcher(quantity_nlp.vocab)
-    
-    for token in full_text:
-        number = token.morph.get("Number")
-        
-        if number:
-            label = number[0].upper()
-            matcher.add(label, patterns=[[{'MORPH': str(token.morph)}]])
-    
-        
-    for verse in verses:
-        matches = matcher(verse)
-        for match_id, start, end in matches:
-            new_ent = Span(verse, start, end, label=match_id)
-            verse.ents = list(verse.ents) + [new_ent]
-            
 
-    return {'text': full_text, 'lines': verses}
+def morph_tables(full_text):
+    # the label each layer gives to every morphological analysis in the text;
+    # an analysis without features stands for the tokens that have none at
+    # all, as the MORPH patterns built from str(token.morph) used to
+    columns = full_text.to_array([POS, MORPH])
+    keys, first = np.unique(columns[:, 1], return_index=True)
+    verbs = set(columns[columns[:, 0] == VERB, 1].tolist())
+    tables = {layer: {} for layer in morph_layers}
 
+    for key, position in zip(keys.tolist(), first.tolist()):
+        morph = full_text[position].morph
+        pattern = key if str(morph) else 0
+        number = morph.get('Number')
+        person = morph.get('Person')
+        tense = morph.get('Tense')
+
+        if number:
+            tables['quantity'][pattern] = number[0].upper()
 
-@st.cache(allow_output_mutation=True)        
-def detect_persons(text):
-    
-    persons_nlp = spacy.load(detect_model, disable=["ner"])
-    full_text = persons_nlp(text)
-    verses = [persons_nlp(verse) for verse in text.split('\n')]
-
-    matcher = Matcher(persons_nlp.vocab)
-    
-    text_to_num = {'first': '1', 'second': '2', 'third': '3',
-                   'one': '1', 'two': '2', 'three': '3'}
-    
-    for token in full_text:
-        person = token.morph.get('Person')
-        number = token.morph.get('Number')
-        
         if person and person[0].isalpha():
             person = [text_to_num[person[0].lower()]]
-            
+        if person:
+            tables['persons'][pattern] = ' '.join(person + number).upper()
 
-        if not person == []:
-            label = ' '.join(person + number).upper()
-            matcher.add(label, patterns=[[{'MORPH': str(token.morph)}]])
-        
-        
-    for verse in verses:
-        matches = matcher(verse)
-        for match_id, start, end in matches:
-            new_ent = Span(verse, start, end, label=match_id)
-            verse.ents = list(verse.ents) + [new_ent]
-            
+        # tenses are read from verbs, then marked on every token sharing
+        # the analysis of one
+        if key in verbs:
+            label = tense[0].upper() if tense else 'OTHER'
+            tables['tenses'][pattern] = 'PRESENT' if label == 'PRES' else label
 
-    return {'text': full_text, 'lines': verses}
+    return tables
 
 
-@st.cache(allow_output_mutation=True)
-def detect_tenses(text):
-    
-    tenses_nlp = spacy.load(detect_model, disable=["ner"])
-    full_text = tenses_nlp(text)
-    verses = [tenses_nlp(verse) for verse in text.split('\n')]
-
-    matcher = Matcher(tenses_nlp.vocab)
-    
-    for token in full_text:
-        if token.pos_ == 'VERB':
-            tense = token.morph.get("Tense")
-            if tense:
-                label = tense[0].upper()
-                if label == 'PRES':
-                    label = 'PRESENT'
-                matcher.add(label, patterns=[[{'MORPH': str(token.morph)}]])
-            else:
-                matcher.add('OTHER', patterns=[[{'MORPH': str(token.morph)}]])
-    
-    for verse in verses:
-        matches = matcher(verse)
-        for match_id, start, end in matches:
-            new_ent = Span(verse, start, end, label=match_id)
-            verse.ents = list(verse.ents) + [new_ent]
-            
+def annotate_morphology(doc, tables):
+    keys = doc.to_array(MORPH)
+    for layer, table in tables.items():
+        positions = np.flatnonzero(np.isin(keys, np.array(list(table), dtype=np.uint64)))
+        doc.spans[layer] = [Span(doc, position, position + 1, label=table[key])
+                            for position, key in zip(positions.tolist(),
+                                                     keys[positions].tolist())]
+    return doc
 
-    return {'text': full_text, 'lines': verses}
 
+def sentiments_matcher(vocab, full_text):
+    # scored per document rather than matched, so verses parsed on their own
+    # get their own scores
+    def matches(doc, offset=0):
+        polarity = sentiment.token_polarity(doc)
+        return [(str(round(score, 1)), position, position + 1)
+                for position, score in zip(np.flatnonzero(polarity).tolist(),
+                                           polarity[polarity != 0].tolist())]
 
-@st.cache(allow_output_mutation=True)        
-def detect_sentiments(text):
-    
-    sentiments_nlp = spacy.load(detect_model, disable=["ner"])
-    sentiments_nlp.add_pipe('spacytextblob')
-    full_text = sentiments_nlp(text)
-    verses = [sentiments_nlp(verse) for verse in text.split('\n')]
-
-    matcher = Matcher(sentiments_nlp.vocab)
-    
-    for token in full_text:
-        if token._.polarity != 0:
-            label = str(round(token._.polarity, 1))
-            matcher.add(key=label, patterns=[[{'TEXT': token.text}]])
-        
-    for verse in verses:
-        matches = matcher(verse)
-        for match_id, start, end in matches:
-            new_ent = Span(verse, start, end, label=match_id)
-            verse.ents = list(verse.ents) + [new_ent]
+    return matches
 
-    return {'text': full_text, 'lines': verses}
 
+def subjectivity_matcher(vocab, full_text):
+    # sentences are scored on the parsed text and cut at line breaks, so a
+    # sentence running over several verses marks each of them
+    sentences = [(line.start, line.end) for line in full_text.sents]
+    scores = sentiment.sentence_scores(full_text, sentences)
+    bounds = verse_bounds(full_text)
+    verse_starts = [start for start, _ in bounds]
+
+    fragments = []
+    for (start, end), (_, score) in zip(sentences, scores):
+        if not score:
+            continue
+        label = str(round(score, 1))
+        line = max(bisect_right(verse_starts, start) - 1, 0)
+        while line < len(bounds) and bounds[line][0] < end:
+            verse_start, verse_end = bounds[line]
+            if min(end, verse_end) > max(start, verse_start):
+                fragments.append((label, max(start, verse_start), min(end, verse_end)))
+            line += 1
+
+    characters = [(label, full_text[start:end].start_char, full_text[start:end].end_char)
+                  for label, start, end in fragments]
+    character_ends = [end for _, _, end in characters]
+
+    def matches(doc, offset=0):
+        if doc is full_text:
+            return fragments
+
+        # verses parsed on their own get the fragments by character offsets
+        projected = []
+        for fragment in range(bisect_right(character_ends, offset), len(characters)):
+            label, start, end = characters[fragment]
+            if start >= offset + len(doc.text):
+                break
+            span = doc.char_span(max(start - offset, 0), min(end - offset, len(doc.text)),
+                                 alignment_mode='contract')
+            if span is not None and len(span):
+                projected.append((label, span.start, span.end))
+
+        return projected
+
+    return matches
+
+
+morph_layers = ['quantity', 'persons', 'tenses']
+layer_matchers = {'pos': pos_matcher,
+                  'sentiments': sentiments_matcher,
+                  'subjectivity': subjectivity_matcher}
+
+
+def annotate(doc, layer, matcher, offset=0):
+    if isinstance(matcher, Matcher):
+        matches = matcher(doc) if len(matcher) else []
+    else:
+        matches = matcher(doc, offset)
+    doc.spans[layer] = [Span(doc, start, end, label=match_id)
+                        for match_id, start, end in matches]
+    return doc
+
+
+def verse_bounds(doc):
+    line_starts = [0] + [match.end() for match in re.finditer('\n', doc.text)]
+    bounds = [None for _ in line_starts]
+
+    for token in doc:
+        if '\n' in token.text:
+            continue
+        line = bisect_right(line_starts, token.idx) - 1
+        if bounds[line] is None:
+            bounds[line] = [token.i, token.i + 1]
+        bounds[line][1] = token.i + 1
+
+    # empty lines get an empty slice where the previous verse ended
+    position = 0
+    for line, bound in enumerate(bounds):
+        if bound is None:
+            bounds[line] = [position, position]
+        position = bounds[line][1]
+
+    return bounds
+
+
+def layer_verses(spacy_text, layer, window=None):
+    if 'layers' in spacy_text:
+        return annotation_store.layer_verses(spacy_text, layer, window)
+
+    verses = doc_verses(spacy_text, layer)
+    return verses if window is None else islice(verses, *window)
 
-@st.cache(allow_output_mutation=True)        
-def detect_subjectivity(text):
-    
-    subjectivity_nlp = spacy.load(detect_model, disable=["ner"])
-    subjectivity_nlp.add_pipe('spacytextblob')
-    full_text = subjectivity_nlp(text)
-    verses = [subjectivity_nlp(verse) for verse in text.split('\n')]
-
-    matcher = PhraseMatcher(subjectivity_nlp.vocab)
-    
-    for line in full_text.sents:
-        if line._.subjectivity:
-            score = line._.subjectivity
-            label = str(round(score, 1))
-            text = line.text.replace('\n', '')
-            matcher.add(key=label, docs=[subjectivity_nlp(text)])
-        
-        
+
+def verse_counts(spacy_text, layer):
+    if 'layers' in spacy_text:
+        return annotation_store.verse_counts(spacy_text, layer)
+
+    return np.array([len(verse['ents']) for verse in doc_verses(spacy_text, layer)],
+                    dtype=np.int64)
+
+
+def verse_texts(spacy_text):
+    if 'layers' in spacy_text:
+        text, bounds = spacy_text['text'], spacy_text['lines'].tolist()
+    else:
+        text, bounds = spacy_text['text'].text, verse_offsets(spacy_text)
+
+    return [text[start:end] for start, end in bounds]
+
+
+def label_counts(spacy_text, layer, window=None):
+    if 'layers' in spacy_text:
+        return annotation_store.label_counts(spacy_text, layer, window)
+
+    return dict(Counter(ent['label'] for verse in layer_verses(spacy_text, layer, window)
+                        for ent in verse['ents']))
+
+
+def stanza_counts(spacy_text, layer):
+    if 'layers' not in spacy_text:
+        spacy_text = compact_analysis(spacy_text, [layer])
+
+    return annotation_store.stanza_counts(spacy_text, layer)
+
+
+def doc_verses(spacy_text, layer):
+    lines = spacy_text['lines']
+    grouped = [[] for _ in lines]
+
+    if lines and not isinstance(lines[0], Doc):
+        starts = [verse.start for verse in lines]
+        for span in spacy_text['text'].spans[layer]:
+            line = bisect_right(starts, span.start) - 1
+            if line >= 0 and span.end <= lines[line].end:
+                grouped[line].append(span)
+    else:
+        grouped = [list(verse.spans[layer]) for verse in lines]
+
+    for verse, spans in zip(lines, grouped):
+        offset = verse.start_char if not isinstance(verse, Doc) else 0
+        yield {'text': verse.text_with_ws, 'title': None,
+               'ents': [{'start': span.start_char - offset,
+                         'end': span.end_char - offset,
+                         'label': span.label_}
+                        for span in filter_spans(spans)]}
+
+
+layer_names = ['ner', 'pos'] + morph_layers + ['sentiments', 'subjectivity']
+summary_layers = ['tenses', 'persons', 'sentiments']
+
+# what each layer reads from the parsed tokens and document; sentiments
+# only need the words, and verses only the line breaks
+layer_needs = {'ner': {'ents'}, 'pos': {'pos'}, 'quantity': {'morph'}, 'persons': {'morph'},
+               'tenses': {'pos', 'morph'}, 'sentiments': set(), 'subjectivity': {'sents'}}
+
+
+@lru_cache(maxsize=None)
+def excluded(layers=tuple(layer_names)):
+    # the pipeline components none of the layers need, left out at load time
+    return tuple(plan(set().union(*(layer_needs[layer] for layer in layers)))['exclude'])
+
+
+def split_verses(full_text):
+    full_text.spans['ner'] = list(full_text.ents)
+    return {'text': full_text,
+            'lines': [full_text[start:end] for start, end in verse_bounds(full_text)]}
+
+
+def parse(text, per_line=False, batch_size=256):
+    with pipeline(exclude=excluded()) as nlp, instrumentation.stage('parse'):
+        full_text = nlp(text)
+        if per_line:
+            verses = list(nlp.pipe(text.split('\n'), batch_size=batch_size))
+
+    instrumentation.note(characters=len(text), tokens=len(full_text),
+                         lines=text.count('\n') + 1)
+
+    if not per_line:
+        return split_verses(full_text)
+
+    full_text.spans['ner'] = list(full_text.ents)
     for verse in verses:
-        matches = matcher(verse)
-        for match_id, start, end in matches:
-            new_ent = Span(verse, start, end, label=match_id)
-            verse.ents = list(verse.ents) + [new_ent]
+        verse.spans['ner'] = list(verse.ents)
 
     return {'text': full_text, 'lines': verses}
 
+
+def add_layers(analysis, layers):
+    full_text = analysis['text']
+
+    # the morphological layers come from one pass over the same table
+    if any(layer in morph_layers for layer in layers):
+        with instrumentation.stage('morphology'):
+            tables = morph_tables(full_text)
+            for doc in [full_text] + analysis['lines']:
+                if isinstance(doc, Doc):
+                    annotate_morphology(doc, tables)
+
+    for layer in layers:
+        if layer in morph_layers:
+            continue
+        with instrumentation.stage(f'matcher {layer}'):
+            matcher = layer_matchers[layer](full_text.vocab, full_text)
+
+        with instrumentation.stage(f'spans {layer}'):
+            annotate(full_text, layer, matcher)
+
+            for verse, (offset, _) in zip(analysis['lines'], verse_offsets(analysis)):
+                if isinstance(verse, Doc):
+                    annotate(verse, layer, matcher, offset)
+
+
+def verse_offsets(analysis):
+    offsets = []
+    position = 0
+    for verse in analysis['lines']:
+        if isinstance(verse, Doc):
+            offsets.append((position, position + len(verse.text)))
+            position += len(verse.text) + 1
+        else:
+            offsets.append((verse.start_char, verse.start_char + len(verse.text_with_ws)))
+
+    return offsets
+
+
+def compact_analysis(analysis, layers=layer_names):
+    return annotation_store.compact(analysis['key'], analysis['text'].text,
+                                    verse_offsets(analysis),
+                                    {layer: [verse['ents'] for verse
+                                             in doc_verses(analysis, layer)]
+                                     for layer in layers})
+
+
+def analysis_key(text, per_line=False):
+    return annotation_cache.cache_key(text, default_model, model_version(),
+                                      filter_version, per_line)
+
+
+# analyses shared by every session of the process, keyed like the disk cache
+# and kept within the memory budget; each entry has its own lock so layers of
+# one text are computed only once
+entry_size = 1024
+# what a parsed token costs with its spans, besides the tensor
+token_bytes = 700
+
+
+def shared_entry(key):
+    return memory_cache.setdefault(('analysis', key),
+                                   {'key': key, 'lock': threading.Lock(),
+                                    'analysis': None, 'stored': False}, entry_size)
+
+
+def analysis_size(analysis):
+    if 'layers' in analysis:
+        return annotation_store.memory_size(analysis)
+
+    docs = [analysis['text']] + [verse for verse in analysis['lines'] if isinstance(verse, Doc)]
+    return sum(len(doc) * token_bytes + doc.tensor.nbytes + len(doc.text) for doc in docs)
+
+
+def account(entry):
+    # with the entry lock held, once its analysis has changed
+    memory_cache.resize(('analysis', entry['key']), analysis_size(entry['analysis']))
+
+
+def load_entry(entry):
+    # with the entry lock held; false when the text has to be parsed
+    if entry['analysis'] is not None:
+        instrumentation.count('memory cache hits')
+        return True
+
+    with instrumentation.stage('disk cache'):
+        data = annotation_cache.load(entry['key'])
+    if not data:
+        instrumentation.count('cache misses')
+        return False
+
+    try:
+        analysis = annotation_store.from_bytes(data, entry['key'])
+    except (zipfile.BadZipFile, ValueError, KeyError, OSError):
+        # a truncated or foreign file would otherwise stay the most recently
+        # used entry and fail every later lookup
+        annotation_cache.remove(entry['key'])
+        instrumentation.count('broken cache entries')
+        return False
+
+    instrumentation.count('disk cache hits')
+    entry['analysis'] = analysis
+    entry['stored'] = True
+    account(entry)
+    return True
+
+
+def analysis_entry(text, per_line=False, batch_size=256):
+    entry = shared_entry(analysis_key(text, per_line))
+
+    with entry['lock']:
+        if not load_entry(entry):
+            entry['analysis'] = parse(text, per_line, batch_size)
+            entry['analysis']['key'] = entry['key']
+            account(entry)
+
+    return entry
+
+
+def analyze(text, layers=layer_names, per_line=False, batch_size=256):
+    entry = analysis_entry(text, per_line, batch_size)
+
+    with entry['lock']:
+        analysis = entry['analysis']
+        # compact stores always hold every layer
+        if 'layers' in analysis:
+            return analysis
+
+        missing = [layer for layer in layers if layer not in analysis['text'].spans]
+        if missing:
+            add_layers(analysis, missing)
+
+        # once every layer is there the documents are dropped for a compact
+        # store, which is also what goes to disk
+        if all(layer in analysis['text'].spans for layer in layer_names):
+            analysis = entry['analysis'] = compact_analysis(analysis)
+            if not entry['stored']:
+                with instrumentation.stage('disk store'):
+                    annotation_cache.store(entry['key'],
+                                           annotation_store.to_bytes(analysis))
+                entry['stored'] = True
+        else:
+            # the documents keep getting layers from other threads, so the
+            # caller gets its layers copied out of them
+            analysis = compact_analysis(analysis, layers)
+        account(entry)
+
+    return analysis
+
+
+def analyze_batch(texts, layers=layer_names, batch_size=256):
+    # the texts nobody has analyzed yet are parsed together in one nlp.pipe
+    entries = {text: shared_entry(analysis_key(text)) for text in texts}
+    missing = []
+    for text, entry in entries.items():
+        with entry['lock']:
+            if not load_entry(entry):
+                missing.append(text)
+
+    if missing:
+        with pipeline(exclude=excluded()) as nlp, instrumentation.stage('parse'):
+            docs = list(nlp.pipe(missing, batch_size=batch_size))
+        instrumentation.note(characters=sum(map(len, missing)),
+                             tokens=sum(map(len, docs)), texts=len(missing))
+
+        for text, doc in zip(missing, docs):
+            entry = entries[text]
+            with entry['lock']:
+                if entry['analysis'] is None:
+                    entry['analysis'] = split_verses(doc)
+                    entry['analysis']['key'] = entry['key']
+                    account(entry)
+
+    return [analyze(text, layers) for text in texts]
+
+
+def prefetch(text, per_line=False):
+    return [workers.submit(analyze, text, [layer], per_line) for layer in layer_names]
+
+
+def cancel_prefetch(futures):
+    for future in futures:
+        future.cancel()
+
+
+def split_stanzas(text):
+    stanzas = []
+    start = 0
+    for separator in re.finditer(r'\n(?:[ \t]*\n)+', text):
+        stanzas.append(text[start:separator.end()])
+        start = separator.end()
+
+    if start < len(text) or not stanzas:
+        stanzas.append(text[start:])
+
+    return stanzas
+
+
+@instrumentation.timed
+def reanalyze(previous, text):
+    return workers.run(splice_stanzas, previous, text)
+
+
+def splice_stanzas(previous, text):
+    # the session keeps a compact store of each stanza, never its documents
+    stanzas = split_stanzas(text)
+    stores = [None for _ in stanzas]
+
+    if previous:
+        matcher = SequenceMatcher(None, previous['stanzas'], stanzas, autojunk=False)
+        for tag, old_start, old_end, start, end in matcher.get_opcodes():
+            if tag == 'equal':
+                stores[start:end] = previous['stores'][old_start:old_end]
+
+    changed = [number for number, store in enumerate(stores) if store is None]
+    instrumentation.count('stanzas reused', len(stores) - len(changed))
+    with pipeline(exclude=excluded()) as nlp, instrumentation.stage('parse'):
+        parsed = list(nlp.pipe([stanzas[number] for number in changed]))
+
+    for number, doc in zip(changed, parsed):
+        analysis = split_verses(doc)
+        add_layers(analysis, layer_names[1:])
+        analysis['key'] = None
+        stores[number] = compact_analysis(analysis)
+
+    # stanzas parsed on their own get other annotations than the whole text,
+    # so the spliced result is shared under a key of its own
+    key = analysis_key(text, 'stanzas')
+    entry = shared_entry(key)
+    with entry['lock']:
+        if entry['analysis'] is None:
+            entry['analysis'] = annotation_store.concatenate(key, stores)
+            account(entry)
+
+    return {'stanzas': stanzas, 'stores': stores, 'analysis': entry['analysis']}
+
+
+@instrumentation.timed
+def detect_ner(text, per_line=False):
+    return workers.run(analyze, text, ['ner'], per_line)
+
+
+@instrumentation.timed
+def detect_pos(text, per_line=False):
+    return workers.run(analyze, text, ['pos'], per_line)
+
+
+@instrumentation.timed
+def detect_quantity(text, per_line=False):
+    return workers.run(analyze, text, ['quantity'], per_line)
+
+
+@instrumentation.timed
+def detect_persons(text, per_line=False):
+    return workers.run(analyze, text, ['persons'], per_line)
+
+
+@instrumentation.timed
+def detect_tenses(text, per_line=False):
+    return workers.run(analyze, text, ['tenses'], per_line)
+
+
+@instrumentation.timed
+def detect_sentiments(text, per_line=False):
+    return workers.run(analyze, text, ['sentiments'], per_line)
+
+
+@instrumentation.timed
+def detect_subjectivity(text, per_line=False):
+    return workers.run(analyze, text, ['subjectivity'], per_line)
+
+
+@instrumentation.timed
+def detect_summary(text, per_line=False):
+    return workers.run(analyze, text, summary_layers, per_line)
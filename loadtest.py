@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from random import Random
+from urllib.request import urlopen
+
+import numpy as np
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from tornado.websocket import websocket_connect
+
+import benchmark
+
+# simulated students each open their own Streamlit session on a server started
+# for the test, paste texts, switch filters and move the opacity slider, and
+# every action is timed from the rerun request to the end of the script run;
+# the texts are the synthetic verses of benchmark.py, and a class pastes the
+# same few poems, so some pastes find their analysis already done
+text_label = '1. Enter a text to analyze:'
+submit_label = 'Analyze'
+filter_label = '2. Generate annotation filters:'
+opacity_label = '--- Levels of annotation presence:'
+
+actions = {'paste': 1, 'filter': 3, 'opacity': 3}
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_server(port, environment, log):
+    # the server log goes to a file, a pipe nobody reads would fill up and
+    # block the server
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'streamlit', 'run',
+         os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'),
+         '--server.headless', 'true', '--server.port', str(port),
+         '--browser.gatherUsageStats', 'false'],
+        env=environment, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            with open(log.name, encoding='utf-8', errors='replace') as output:
+                raise RuntimeError('the server stopped:\n' + output.read()[-2000:])
+        try:
+            with urlopen(f'http://127.0.0.1:{port}/healthz', timeout=1):
+                return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.kill()
+    raise RuntimeError('the server did not start within a minute')
+
+
+def resident_memory(pid):
+    # Linux only, None elsewhere
+    try:
+        with open(f'/proc/{pid}/status', encoding='ascii') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+class Session:
+    def __init__(self, port, number, texts, seed):
+        self.url = f'ws://127.0.0.1:{port}/stream'
+        self.number = number
+        self.texts = texts
+        self.random = Random(seed)
+        self.widgets = {}
+        self.states = {}
+        self.errors = []
+
+    async def open(self):
+        self.connection = await websocket_connect(self.url)
+        return await self.rerun({})
+
+    async def rerun(self, changes, trigger=None):
+        self.states.update(changes)
+        message = BackMsg()
+        message.rerun_script.query_string = ''
+        for label, value in self.states.items():
+            if label not in self.widgets:
+                continue
+            state = message.rerun_script.widget_states.widgets.add()
+            state.id = self.widgets[label]['id']
+            if isinstance(value, str):
+                state.string_value = value
+            elif isinstance(value, list):
+                state.double_array_value.data.extend(value)
+            else:
+                state.int_value = value
+        if trigger is not None:
+            state = message.rerun_script.widget_states.widgets.add()
+            state.id = self.widgets[trigger]['id']
+            state.trigger_value = True
+
+        start = time.perf_counter()
+        await self.connection.write_message(message.SerializeToString(), binary=True)
+        while True:
+            data = await self.connection.read_message()
+            if data is None:
+                raise ConnectionError('the server closed the session')
+
+            forward = ForwardMsg()
+            forward.ParseFromString(data)
+            kind = forward.WhichOneof('type')
+            if kind == 'script_finished':
+                return time.perf_counter() - start
+            if kind == 'delta' and forward.delta.WhichOneof('type') == 'new_element':
+                self.read_element(forward.delta.new_element)
+
+    def read_element(self, element):
+        kind = element.WhichOneof('type')
+        inner = getattr(element, kind)
+        if kind == 'exception':
+            self.errors.append(f'{inner.type}: {inner.message}')
+        elif hasattr(inner, 'id') and hasattr(inner, 'label'):
+            # widgets get new ids when their arguments change, like the
+            # slider range of some filters
+            self.widgets[inner.label] = {'id': inner.id, 'kind': kind, 'widget': inner}
+
+    async def act(self):
+        action = self.random.choices(list(actions), list(actions.values()))[0]
+        if action == 'opacity' and opacity_label not in self.widgets:
+            action = 'filter'
+
+        if action == 'paste':
+            text = self.random.choice(self.texts)
+            return action, await self.rerun({text_label: text}, trigger=submit_label)
+        if action == 'filter':
+            options = len(self.widgets[filter_label]['widget'].options)
+            return action, await self.rerun({filter_label: self.random.randrange(options)})
+
+        slider = self.widgets[opacity_label]['widget']
+        value = float(self.random.randint(int(slider.min), int(slider.max)))
+        return action, await self.rerun({opacity_label: [value]})
+
+    def close(self):
+        self.connection.close()
+
+
+async def simulate(session, start, deadline, think, timings):
+    await asyncio.sleep(start)
+    timings.append({'action': 'open', 'seconds': await session.open(),
+                    'session': session.number, 'time': time.monotonic()})
+
+    while time.monotonic() < deadline:
+        await asyncio.sleep(session.random.expovariate(1 / think) if think else 0)
+        action, seconds = await session.act()
+        timings.append({'action': action, 'seconds': seconds,
+                        'session': session.number, 'time': time.monotonic()})
+
+    session.close()
+
+
+async def sample_memory(pid, interval, started, samples, finished):
+    while not finished.is_set():
+        samples.append({'seconds': time.monotonic() - started, 'rss': resident_memory(pid)})
+        try:
+            await asyncio.wait_for(finished.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+    samples.append({'seconds': time.monotonic() - started, 'rss': resident_memory(pid)})
+
+
+async def drive(port, pid, args, texts):
+    started = time.monotonic()
+    deadline = started + args.ramp + args.duration
+    timings = []
+    samples = []
+    finished = asyncio.Event()
+    sessions = [Session(port, number, texts, args.seed + number)
+                for number in range(args.sessions)]
+
+    sampler = asyncio.ensure_future(sample_memory(pid, args.interval, started, samples,
+                                                  finished))
+    await asyncio.gather(*(simulate(session, args.ramp * number / args.sessions,
+                                    deadline, args.think, timings)
+                           for number, session in enumerate(sessions)))
+    finished.set()
+    await sampler
+
+    return {'seconds': time.monotonic() - started, 'timings': timings, 'memory': samples,
+            'errors': [error for session in sessions for error in session.errors]}
+
+
+def latencies(timings):
+    groups = {}
+    for timing in timings:
+        groups.setdefault(timing['action'], []).append(timing['seconds'])
+    groups['all actions'] = [timing['seconds'] for timing in timings
+                             if timing['action'] != 'open']
+
+    return {action: {'count': len(seconds),
+                     **{f'p{share}': float(np.percentile(seconds, share)) if seconds else None
+                        for share in (50, 95, 99)}}
+            for action, seconds in groups.items()}
+
+
+def compare(action, result, baseline, tolerance):
+    previous = baseline.get(action)
+    if not previous or not previous['p95'] or result['p95'] is None:
+        return '', False
+
+    ratio = result['p95'] / previous['p95']
+    return f'{ratio:6.2f}x', ratio > 1 + tolerance
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Start the app and drive it with simulated sessions pasting texts, '
+        'switching filters and moving the opacity slider; reports the latency '
+        'percentiles of each action, the throughput and the memory of the server.')
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=60,
+                        help='seconds every session keeps acting once all are open')
+    parser.add_argument('--ramp', type=float, default=10,
+                        help='seconds over which the sessions open')
+    parser.add_argument('--think', type=float, default=2,
+                        help='mean seconds between the actions of a session')
+    parser.add_argument('--texts', type=int, default=12,
+                        help='different texts the sessions paste')
+    parser.add_argument('--sizes', nargs='+', choices=benchmark.sizes,
+                        default=['stanza', 'poem', 'chapbook'],
+                        help='text sizes to paste, from benchmark.py')
+    parser.add_argument('--pipeline', choices=['model', 'tiny'], default='model',
+                        help='the configured spaCy model, or the rule based stand-in '
+                        'of benchmark.py, which needs no download')
+    parser.add_argument('--interval', type=float, default=5,
+                        help='seconds between memory samples')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='p95 slowdown against the baseline reported as a regression')
+    args = parser.parse_args(argv)
+
+    random = Random(args.seed)
+    texts = [benchmark.synthetic_text(benchmark.sizes[random.choice(args.sizes)], seed)
+             for seed in range(args.texts)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        # every run starts with an empty disk cache
+        environment = dict(os.environ, TEXTGLYPHS_CACHE_DIR=os.path.join(directory, 'cache'))
+        if args.pipeline == 'tiny':
+            benchmark.tiny_pipeline().to_disk(os.path.join(directory, 'tiny'))
+            environment['TEXTGLYPHS_MODEL'] = os.path.join(directory, 'tiny')
+
+        port = free_port()
+        with open(os.path.join(directory, 'server.log'), 'wb') as log:
+            server = start_server(port, environment, log)
+            try:
+                results = asyncio.run(drive(port, server.pid, args, texts))
+            finally:
+                server.terminate()
+                server.wait()
+
+    actions_done = sum(1 for timing in results['timings'] if timing['action'] != 'open')
+    throughput = actions_done / max(results['seconds'] - args.ramp, 1e-9)
+    table = latencies(results['timings'])
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as saved:
+            baseline = json.load(saved)['latencies']
+
+    print(f'{args.sessions} sessions, {actions_done} actions in {results["seconds"]:.1f} s, '
+          f'{throughput:.2f} actions/s, {len(results["errors"])} errors')
+    print(f'{"action":<14}{"count":>7}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"baseline":>10}')
+    regressions = 0
+    for action, result in table.items():
+        ratio, regressed = compare(action, result, baseline, args.tolerance)
+        regressions += regressed
+        print(f'{action:<14}{result["count"]:>7}' +
+              ''.join(f'{result[share] * 1000:>10.0f}' if result[share] is not None
+                      else f'{"-":>10}' for share in ('p50', 'p95', 'p99')) +
+              f'{ratio:>10}{" !" if regressed else ""}')
+
+    print(f'{"seconds":>8}{"RSS MiB":>10}')
+    for sample in results['memory']:
+        rss = '-' if sample['rss'] is None else f'{sample["rss"] / 2 ** 20:.0f}'
+        print(f'{sample["seconds"]:>8.0f}{rss:>10}')
+
+    for error in sorted(set(results['errors']))[:10]:
+        print(error, file=sys.stderr)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as saved:
+            json.dump({'pipeline': args.pipeline, 'model': benchmark.models.default_model,
+                       'settings': vars(args), 'throughput': throughput,
+                       'latencies': table, 'memory': results['memory'],
+                       'errors': results['errors'], 'timings': results['timings']},
+                      saved, indent=1)
+
+    if regressions:
+        print(f'{regressions} action(s) slower than the baseline by more than '
+              f'{args.tolerance:.0%}', file=sys.stderr)
+    return 1 if results['errors'] or regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
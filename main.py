@@ -1,12 +1,8 @@
+import importlib
+import os
+import time
 import streamlit as st
-import subprocess
-from language_processing import *
-from visualizers import *
-
-
-if 'textblob' not in st.session_state:
-    subprocess.run(['python3', '-m', 'textblob.download_corpora'])
-    st.session_state.textblob = True
+import instrumentation
 
 if 'text' not in st.session_state:
     st.session_state.text = ('A Drop Fell on the Apple Tree - \n'
@@ -55,8 +51,89 @@ def opacity_ruler(max = 10, start = 5):
     return opacity
 
 
+# texts with more verses are shown one page at a time
+paged_lines = 150
+
+
+def page_navigator(spacy_text, layer):
+    if st.session_state.text.count('\n') < paged_lines:
+        return None
+
+    from visualizers import display_page_labels, page_bounds, page_counts
+
+    page_lines = st.sidebar.number_input('--- Verses per page:', 20, 1000, 60, step=20)
+    pages = page_bounds(spacy_text, page_lines)
+    counts = page_counts(spacy_text, layer, pages)
+    page = st.sidebar.selectbox('--- Page:', range(len(pages)),
+                                format_func=lambda page: f'{page + 1}. verses '
+                                f'{pages[page][0] + 1}-{pages[page][1]} ({counts[page]} annotations)')
+
+    display_page_labels(spacy_text, layer, pages[page])
+    return pages[page]
+
+
+def spliced(incremental):
+    # stanzas re-analyzed on their own are only shown to the session that
+    # edited them, other sessions get the analysis of the whole text
+    stanzas = st.session_state.get('stanzas')
+    if incremental and stanzas and stanzas['analysis']['text'] == st.session_state.text:
+        return stanzas['analysis']
+    return None
+
+
+def analyzed(detect, incremental):
+    analysis = spliced(incremental)
+    return reached(detect, st.session_state.text) if analysis is None else analysis
+
+
+def reached(function, *args):
+    # an analysis service that is down or too slow ends the page with its
+    # error instead of a traceback
+    try:
+        return function(*args)
+    except ConnectionError as error:
+        st.error(str(error))
+        st.stop()
+
+
+def bundle_picker():
+    from export import bundle_index, load_bundle
+
+    bundles = {bundle['id']: bundle for bundle in bundle_index().values()}
+    chosen = st.sidebar.selectbox('0. Choose a prepared text:', [None] + sorted(bundles),
+                                  format_func=lambda text_id: '-' if text_id is None
+                                  else f'{text_id}: {bundles[text_id]["title"]}')
+
+    if chosen is not None and chosen != st.session_state.get('bundle'):
+        st.session_state.bundle = chosen
+        st.session_state.text = load_bundle(chosen)['text']
+        st.session_state.analyzed_text = False
+
+
+def corpus_search(opacity):
+    from corpus_index import search
+    from visualizers import display_hits
+
+    query = st.sidebar.text_input('--- Query:', 'tenses:PAST AND pos:PRON',
+                                  help='Labels of the filters, such as tenses:PAST or '
+                                  'persons:"2 SING", joined with AND, OR, NOT and brackets, '
+                                  'and the mean sentiment of verses or stanzas, such as '
+                                  'polarity > 0.5 or stanza_polarity < -0.3')
+    try:
+        results = search(query)
+    except ValueError as error:
+        st.sidebar.error(str(error))
+        return
+
+    display_hits(results, opacity)
+
+
 def main():
     meta_data()
+
+    # prepared texts are shown from their exported annotations
+    if os.environ.get('TEXTGLYPHS_BUNDLES'):
+        bundle_picker()
     
     st.sidebar.info('This tool uses artificial intelligence to extract features of language')
     
@@ -66,6 +143,9 @@ def main():
                             value=st.session_state.text, height=100,
                             help='You can copy paste a text here '
                                 'and collapse this box.')
+        incremental = st.checkbox('only re-analyze edited stanzas', False,
+                                  help='Faster for small corrections in long texts, '
+                                  'each stanza is then analyzed on its own.')
         new_text = st.form_submit_button(label='Analyze',
                               help='Save the text in the box above.')
         if new_text:
@@ -79,55 +159,94 @@ def main():
             '\N{Paperclip} named or specific things',
             '\N{Performing Arts} sentiments',
             '\N{Thought Balloon} subjectivity', 
+            '\N{Bar Chart} summary',
             'plain text']
-    
+    if os.environ.get('TEXTGLYPHS_INDEX'):
+        menu.insert(-1, '\N{Card Index} search the corpus')
+
+
     current = st.sidebar.radio('2. Generate annotation filters:', menu,
                                help='These filters give new perspectives on '
                                'the text, or uncover some of its language features')
 
-    filters = (detect_pos, detect_ner, detect_tenses, detect_quantity,
-               detect_persons, detect_sentiments, detect_subjectivity)
-    
-    if st.session_state.analyzed_text == False:
-        loading_bar = st.progress(0)
-        for step, f in enumerate(filters):
-            loading_bar.progress(1/len(filters) * step)
-            f(st.session_state.text)
+    debug = instrumentation.enabled or 'debug' in st.experimental_get_query_params()
+    if debug:
+        instrumentation.start_run(filter=current)
+
+    # spaCy comes with the analysis modules, which are only imported once
+    # the sidebar is on the page
+    start = time.perf_counter()
+    with instrumentation.stage('imports'):
+        # the analyses come from the exported bundles, from service.py with no
+        # model in this process, or from the model loaded here
+        if os.environ.get('TEXTGLYPHS_BUNDLES'):
+            backend = importlib.import_module('export')
+        elif os.environ.get('TEXTGLYPHS_SERVICE'):
+            backend = importlib.import_module('service')
+        else:
+            backend = importlib.import_module('language_processing')
+        from visualizers import (display_metrics, display_ner, display_persons,
+                                 display_pos, display_quantity, display_sentiments,
+                                 display_subjectivity, display_summary, display_tenses)
+    imports = time.perf_counter() - start
+
+    new_analysis = st.session_state.analyzed_text == False
+    if new_analysis:
+        backend.cancel_prefetch(st.session_state.get('prefetch', []))
+        if incremental:
+            st.session_state.stanzas = reached(backend.reanalyze,
+                                               st.session_state.get('stanzas'),
+                                               st.session_state.text)
         st.session_state.analyzed_text = True
-        loading_bar.empty()
 
     if current == '\N{Jigsaw Puzzle Piece} syntax structure':
         opacity = opacity_ruler()
-        display_pos(detect_pos(st.session_state.text), 'pattern', opacity)
+        spacy_text = analyzed(backend.detect_pos, incremental)
+        display_pos(spacy_text, 'pattern', opacity, page_navigator(spacy_text, 'pos'))
 
     elif current == '\N{Right-Pointing Magnifying Glass} search by word class':
         opacity = opacity_ruler()
-        display_pos(detect_pos(st.session_state.text), 'search', opacity)
+        spacy_text = analyzed(backend.detect_pos, incremental)
+        display_pos(spacy_text, 'search', opacity, page_navigator(spacy_text, 'pos'))
 
     elif current == '\N{Paperclip} named or specific things':
         opacity = opacity_ruler(max=3, start=2)
-        display_ner(detect_ner(st.session_state.text), opacity)
+        spacy_text = analyzed(backend.detect_ner, incremental)
+        display_ner(spacy_text, opacity, page_navigator(spacy_text, 'ner'))
         
     elif current == '\N{Hourglass with Flowing Sand} tenses':
         opacity = opacity_ruler(max=3, start=2)
-        display_tenses(detect_tenses(st.session_state.text), opacity)
+        spacy_text = analyzed(backend.detect_tenses, incremental)
+        display_tenses(spacy_text, opacity, page_navigator(spacy_text, 'tenses'))
         
     elif current == '\N{Scales} quantities':
         opacity = opacity_ruler()
-        display_quantity(detect_quantity(st.session_state.text), opacity)
+        spacy_text = analyzed(backend.detect_quantity, incremental)
+        display_quantity(spacy_text, opacity, page_navigator(spacy_text, 'quantity'))
         
     elif current == '\N{Busts in Silhouette} persons':
         opacity = opacity_ruler()
-        display_persons(detect_persons(st.session_state.text), opacity)
+        spacy_text = analyzed(backend.detect_persons, incremental)
+        display_persons(spacy_text, opacity, page_navigator(spacy_text, 'persons'))
         
     elif current == '\N{Performing Arts} sentiments':
         opacity = opacity_ruler()
-        display_sentiments(detect_sentiments(st.session_state.text), opacity)
+        spacy_text = analyzed(backend.detect_sentiments, incremental)
+        display_sentiments(spacy_text, opacity, page_navigator(spacy_text, 'sentiments'))
         
     elif current == '\N{Thought Balloon} subjectivity':
         opacity = opacity_ruler()
-        display_subjectivity(detect_subjectivity(st.session_state.text), opacity)
+        spacy_text = analyzed(backend.detect_subjectivity, incremental)
+        display_subjectivity(spacy_text, opacity, page_navigator(spacy_text, 'subjectivity'))
+        
+    elif current == '\N{Bar Chart} summary':
+        spacy_text = analyzed(backend.detect_summary, incremental)
+        display_summary(spacy_text)
         
+    elif current == '\N{Card Index} search the corpus':
+        opacity = opacity_ruler()
+        corpus_search(opacity)
+
     else: 
         if st.sidebar.checkbox('numberng', True):
             st.markdown('1. ' + st.session_state.text.replace('\n\n', '---\n'
@@ -137,6 +256,16 @@ def main():
             st.markdown(st.session_state.text.replace('\n\n', '\n---\n'
                                                   ).replace('\n', '\n\n'))
 
+    # the chosen filter is already on the page, the others are computed
+    # in the background so switching filters is instant; spliced stanzas
+    # already carry every layer
+    if new_analysis and spliced(incremental) is None:
+        st.session_state.prefetch = backend.prefetch(st.session_state.text)
+
+    instrumentation.report_startup(imports=imports)
+    if debug:
+        display_metrics(instrumentation.finish_run())
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import instrumentation
+
+# every result the process keeps in memory, analyses, fetched and bundled
+# stores, rendered poems, shares one budget of estimated bytes; the least
+# recently used results are evicted first, and with a time to live any result
+# left untouched for longer goes too
+memory_budget = int(os.environ.get('TEXTGLYPHS_MEMORY_BUDGET', 256 * 1024 * 1024))
+time_to_live = float(os.environ.get('TEXTGLYPHS_CACHE_TTL', 0))
+
+# the first part of each key names the kind of result, for the counters
+entries = OrderedDict()
+entries_lock = threading.RLock()
+used = 0
+stats = Counter()
+
+
+def get(key):
+    with entries_lock:
+        expire()
+        entry = entries.get(key)
+        if entry is None:
+            stats[f'{key[0]} misses'] += 1
+            return None
+
+        entries.move_to_end(key)
+        entry['used'] = time.monotonic()
+        stats[f'{key[0]} hits'] += 1
+        return entry['value']
+
+
+def put(key, value, size):
+    global used
+    with entries_lock:
+        previous = entries.pop(key, None)
+        if previous is not None:
+            used -= previous['size']
+
+        # a result larger than the whole budget is handed out but not kept
+        if size <= memory_budget:
+            entries[key] = {'value': value, 'size': size, 'used': time.monotonic()}
+            used += size
+        evict()
+
+    return value
+
+
+def setdefault(key, value, size):
+    with entries_lock:
+        kept = get(key)
+        return put(key, value, size) if kept is None else kept
+
+
+def resize(key, size):
+    # for results that grow after they are shared, like analyses getting layers
+    global used
+    with entries_lock:
+        entry = entries.get(key)
+        if entry is not None:
+            used += size - entry['size']
+            entry['size'] = size
+            evict()
+
+
+def clear(*kinds):
+    # every entry, or only those of the given kinds
+    global used
+    with entries_lock:
+        for key in [key for key in entries if not kinds or key[0] in kinds]:
+            used -= entries.pop(key)['size']
+
+
+def expire():
+    global used
+    if not time_to_live:
+        return
+
+    # the least recently used entries are first, so the scan stops at the
+    # first one still alive
+    deadline = time.monotonic() - time_to_live
+    while entries:
+        key, entry = next(iter(entries.items()))
+        if entry['used'] > deadline:
+            break
+        del entries[key]
+        used -= entry['size']
+        stats['expired'] += 1
+
+
+def evict():
+    global used
+    while used > memory_budget and entries:
+        _, entry = entries.popitem(last=False)
+        used -= entry['size']
+        stats['evicted'] += 1
+        instrumentation.count('memory cache evictions')
+
+
+def summary():
+    with entries_lock:
+        expire()
+        return dict(sorted(stats.items()), entries=len(entries), bytes=used,
+                    budget=memory_budget)
+
+
+instrumentation.watch('memory cache', summary)
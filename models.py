@@ -0,0 +1,143 @@
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import spacy
+from spacy.language import Language
+from spacy.util import get_package_path, get_package_version, load_config, load_meta
+
+import instrumentation
+
+default_model = os.environ.get('TEXTGLYPHS_MODEL', 'en_core_web_sm')
+
+# one loaded pipeline per model name and excluded components for the whole
+# process, shared by every Streamlit session; the lock guards the
+# enabled/disabled pipe state
+models = {}
+models_lock = threading.Lock()
+
+# documents run through any pipeline, for the benchmarks
+stats = {'parses': 0}
+
+# what the components of the spaCy pipelines add to the tokens and the
+# document, by factory, and what they read that an earlier component adds;
+# embedding components are needed by the components listening to them
+factory_assigns = {'tagger': {'tag'}, 'morphologizer': {'pos', 'morph'},
+                   'attribute_ruler': {'pos', 'morph'}, 'lemmatizer': {'lemma'},
+                   'parser': {'sents', 'deps'}, 'senter': {'sents'},
+                   'sentencizer': {'sents'}, 'ner': {'ents'}, 'entity_ruler': {'ents'},
+                   'tok2vec': set(), 'transformer': set()}
+factory_requires = {'attribute_ruler': {'tag'}, 'lemmatizer': {'pos'}}
+embeddings = {'tok2vec', 'transformer'}
+
+
+@Language.component('parse_counter')
+def parse_counter(doc):
+    stats['parses'] += 1
+    instrumentation.count('parses')
+    return doc
+
+
+def register_model(nlp, name=default_model):
+    nlp.add_pipe('parse_counter', first=True)
+    with models_lock:
+        models[name, ()] = {'nlp': nlp, 'lock': threading.RLock()}
+
+
+def load_model(name=default_model, exclude=()):
+    # a pipeline with every component, loaded or registered, serves the
+    # smaller ones too, with the excluded components disabled
+    key = (name, tuple(sorted(exclude)))
+    with models_lock:
+        if key not in models and (name, ()) in models:
+            key = (name, ())
+        if key not in models:
+            with instrumentation.stage('model load'):
+                nlp = spacy.load(name, exclude=list(exclude))
+                nlp.add_pipe('parse_counter', first=True)
+            models[key] = {'nlp': nlp, 'lock': threading.RLock()}
+
+    return models[key]
+
+
+def model_config(name=default_model):
+    if (name, ()) in models:
+        return models[name, ()]['nlp'].config
+    if os.path.isdir(name):
+        return load_config(Path(name) / 'config.cfg', interpolate=False)
+
+    path = get_package_path(name)
+    meta = load_meta(path / 'meta.json')
+    return load_config(path / f'{meta["lang"]}_{meta["name"]}-{meta["version"]}' / 'config.cfg',
+                       interpolate=False)
+
+
+def listened(settings):
+    # the embedding components a component listens to, '*' for any of them
+    if isinstance(settings, dict):
+        if 'Listener' in str(settings.get('@architectures', '')):
+            yield settings.get('upstream', '*')
+        for value in settings.values():
+            yield from listened(value)
+
+
+def plan_components(config, needs):
+    # walking back from the last component, one is kept when it adds
+    # something needed, and what it reads is needed from the ones before it;
+    # components of unknown factories are always kept
+    names = list(config['nlp']['pipeline'])
+    disabled = set(config['nlp'].get('disabled', []))
+    settings = config['components']
+    needs = set(needs)
+    upstreams = set()
+    keep = set()
+
+    for name in reversed(names):
+        factory = settings[name].get('factory')
+        if name in disabled:
+            continue
+        if factory in embeddings:
+            if name in upstreams or '*' in upstreams:
+                keep.add(name)
+            continue
+        if factory in factory_assigns and not factory_assigns[factory] & needs:
+            continue
+
+        keep.add(name)
+        needs |= factory_requires.get(factory, set())
+        upstreams.update(listened(settings[name]))
+
+    return {'keep': [name for name in names if name in keep],
+            'exclude': [name for name in names if name not in keep]}
+
+
+def plan(needs, name=default_model):
+    try:
+        config = model_config(name)
+    except (ImportError, OSError, ValueError):
+        # without a config to read, nothing can be left out safely
+        return {'keep': [], 'exclude': []}
+
+    return plan_components(config, needs)
+
+
+@contextmanager
+def pipeline(name=default_model, disable=(), exclude=()):
+    model = load_model(name, exclude)
+    nlp = model['nlp']
+
+    disable = [pipe for pipe in list(disable) + list(exclude) if pipe in nlp.pipe_names]
+    with model['lock'], nlp.select_pipes(disable=disable):
+        yield nlp
+
+
+def model_version(name=default_model):
+    for (loaded, _), model in list(models.items()):
+        if loaded == name:
+            return model['nlp'].meta['version']
+    if os.path.isdir(name):
+        return load_meta(os.path.join(name, 'meta.json'))['version']
+
+    return get_package_version(name)
+
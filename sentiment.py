@@ -0,0 +1,274 @@
+import argparse
+import re
+import sys
+import threading
+
+import numpy as np
+from spacy.attrs import IS_SPACE, LENGTH, LOWER, SPACY
+from spacy.strings import hash_string
+
+# TextBlob's pattern lexicon compiled into arrays sorted by the hash spaCy
+# gives the lowercase form of a token, so a whole document is scored with
+# one searchsorted instead of a TextBlob per token or sentence
+negations = ('no', 'not', "n't", 'never')
+apostrophes = re.compile("(['\u2019])")
+lexicon = {}
+lexicon_lock = threading.Lock()
+
+
+def load_lexicon():
+    with lexicon_lock:
+        if lexicon:
+            return lexicon
+
+        from textblob._text import EMOTICONS, PUNCTUATION
+        from textblob.en import sentiment
+
+        if not dict.__len__(sentiment):
+            sentiment.load()
+        entries = {hash_string(word): (scores[None], 'RB' in scores, word.endswith('ly'))
+                   for word, scores in dict.items(sentiment)}
+        hashes = np.array(sorted(entries), dtype=np.uint64)
+        rows = [entries[key] for key in hashes.tolist()]
+
+        lexicon['hashes'] = hashes
+        lexicon['scores'] = np.array([row[0] for row in rows], dtype=np.float64)
+        lexicon['modifier'] = np.array([row[1] for row in rows], dtype=bool)
+        lexicon['ly'] = np.array([row[2] for row in rows], dtype=bool)
+        lexicon['negations'] = np.array([hash_string(word) for word in negations],
+                                        dtype=np.uint64)
+        lexicon['exclamation'] = hash_string('!')
+        lexicon['sarcasm'] = [hash_string(mark) for mark in '(!)']
+        lexicon['emoticons'] = {}
+        for (_, polarity), emoticons in EMOTICONS.items():
+            for emoticon in emoticons:
+                if not emoticon.isalpha() and len(emoticon) <= 5 and emoticon not in PUNCTUATION:
+                    lexicon['emoticons'].setdefault(hash_string(emoticon.lower()), polarity)
+
+    return lexicon
+
+
+def lookup(doc):
+    table = load_lexicon()
+    columns = doc.to_array([LOWER, LENGTH, IS_SPACE])
+    lower = columns[:, 0].astype(np.uint64)
+
+    found = np.searchsorted(table['hashes'], lower).clip(max=len(table['hashes']) - 1)
+    known = table['hashes'][found] == lower
+
+    emoticon = np.zeros(len(doc), dtype=np.float64)
+    is_emoticon = np.zeros(len(doc), dtype=bool)
+    for position in np.flatnonzero(~known & (columns[:, 1] <= 5)).tolist():
+        polarity = table['emoticons'].get(int(lower[position]))
+        if polarity is not None:
+            emoticon[position] = polarity
+            is_emoticon[position] = True
+
+    return {'lower': lower, 'length': columns[:, 1], 'space': columns[:, 2].astype(bool),
+            'known': known, 'found': found, 'emoticon': emoticon,
+            'is_emoticon': is_emoticon}
+
+
+def word_flags(word, table):
+    # what sentence_scores reads of one word TextBlob sees
+    lower = word.lower()
+    key = np.uint64(hash_string(lower))
+    found = min(int(np.searchsorted(table['hashes'], key)), len(table['hashes']) - 1)
+    known = bool(table['hashes'][found] == key)
+    emoticon = None if known or len(word) > 5 else table['emoticons'].get(int(key))
+    return {'known': known, 'scores': table['scores'][found].tolist(),
+            'modifier': known and bool(table['modifier'][found]),
+            'ly': bool(table['ly'][found]), 'negation': lower in negations,
+            'exclamation': lower == '!', 'sarcasm': False,
+            'is_emoticon': emoticon is not None, 'emoticon': emoticon or 0.0,
+            'long_word': len(word) > 2, 'long_stripped': len(word.strip("'")) > 1}
+
+
+def textblob_words(doc, table):
+    # TextBlob splits words around apostrophes, so "n't" is "n", "'" and "t"
+    # and never a negation, and with a curly apostrophe "wasn’t" is "wasn",
+    # "’" and "t" where spaCy has "was" and "n’t": the words TextBlob
+    # reads in place of the tokens that differ
+    words = {}
+    for token in doc:
+        if "'" not in token.text and '\u2019' not in token.text:
+            continue
+        pieces = [piece for piece in apostrophes.split(token.text) if piece]
+        if (token.i and pieces[:2] == ['n', '\u2019']
+                and not doc[token.i - 1].whitespace_):
+            words.setdefault(token.i - 1, [doc[token.i - 1].text])[-1] += pieces.pop(0)
+        words[token.i] = pieces
+
+    return {position: [word_flags(word, table) for word in pieces]
+            for position, pieces in words.items()}
+
+
+def token_polarity(doc):
+    # what TextBlob gives every token on its own: the lexicon score of a
+    # known word, or the mood of an emoticon
+    tokens = lookup(doc)
+    scores = load_lexicon()['scores'][tokens['found'], 0]
+    return np.where(tokens['known'], scores, tokens['emoticon'])
+
+
+def sentence_scores(doc, sentences):
+    # TextBlob's assessments, with modifiers ("very good"), negations ("not
+    # good" scores -0.5 times "good") and exclamation marks ("good!" scores
+    # 1.25 times), over each (start, end) token range of the document
+    table = load_lexicon()
+    tokens = lookup(doc)
+    lower = tokens['lower']
+    known = tokens['known']
+    scores = table['scores'][tokens['found']]
+    modifier = table['modifier'][tokens['found']] & known
+    ly = table['ly'][tokens['found']]
+    negation = np.isin(lower, table['negations'])
+    exclamation = lower == table['exclamation']
+
+    long_word = tokens['length'] > 2
+    quotes = [position for position, token in enumerate(doc) if "'" in token.text]
+    long_stripped = tokens['length'] > 1
+    long_stripped[quotes] = [len(doc[position].text.strip("'")) > 1 for position in quotes]
+
+    # TextBlob reads the sarcasm mark (!) as one word where spaCy has three
+    # tokens; the first stands for the mark and the other two are skipped
+    sarcasm = np.zeros(len(doc), dtype=bool)
+    if len(doc) > 2:
+        joined = doc.to_array(SPACY)[:-1] == 0
+        opening, mark, closing = table['sarcasm']
+        sarcasm[:-2] = ((lower[:-2] == opening) & (lower[1:-1] == mark)
+                        & (lower[2:] == closing) & joined[:-1] & joined[1:])
+    skipped = np.zeros(len(doc), dtype=bool)
+    skipped[1:] |= sarcasm[:-1]
+    skipped[2:] |= sarcasm[:-2]
+    long_word |= sarcasm
+    long_stripped |= sarcasm
+    exclamation &= ~skipped
+
+    # tokens with apostrophes are walked as the words TextBlob makes of them
+    split = textblob_words(doc, table)
+    rewritten = np.zeros(len(doc), dtype=bool)
+    rewritten[list(split)] = True
+
+    # an unknown long word forgets any preceding modifier and negation, so only
+    # the other tokens need to be walked through one by one
+    plain = (~known & ~negation & ~exclamation & ~sarcasm & ~tokens['is_emoticon']
+             & long_word & long_stripped & ~tokens['space'] & ~skipped & ~rewritten)
+    walked = ~plain & ~tokens['space'] & ~skipped
+    resets = np.concatenate([[0], np.cumsum(plain)])
+
+    columns = {'known': known, 'scores': scores, 'modifier': modifier, 'ly': ly,
+               'negation': negation, 'exclamation': exclamation, 'sarcasm': sarcasm,
+               'is_emoticon': tokens['is_emoticon'], 'emoticon': tokens['emoticon'],
+               'long_word': long_word, 'long_stripped': long_stripped}
+    columns = {name: values.tolist() for name, values in columns.items()}
+
+    results = []
+    for start, end in sentences:
+        assessments = []
+        modifying = None
+        negated = False
+        previous = start
+        for position in (start + np.flatnonzero(walked[start:end])).tolist():
+            if resets[position] > resets[previous]:
+                modifying = None
+                negated = False
+            previous = position
+
+            words = split.get(position) or [{name: values[position]
+                                             for name, values in columns.items()}]
+            for word in words:
+                if word['known']:
+                    polarity, subjectivity, intensity = word['scores']
+                    if modifying is None:
+                        assessments.append([polarity, subjectivity, intensity, 1])
+                    else:
+                        last = assessments[-1]
+                        last[0] = max(-1.0, min(polarity * last[2], 1.0))
+                        last[1] = max(-1.0, min(subjectivity * last[2], 1.0))
+                        last[2] = intensity
+                    if negated:
+                        assessments[-1][2] = 1.0 / assessments[-1][2]
+                        assessments[-1][3] = -1
+                    modifying = word['ly'] if word['modifier'] else None
+                    negated = word['negation']
+                    continue
+
+                if word['negation']:
+                    negated = True
+                elif negated and word['long_stripped']:
+                    negated = False
+                if negated and modifying:
+                    assessments[-1][3] = -1
+                    negated = False
+                elif modifying is not None and word['long_word']:
+                    modifying = None
+                if word['exclamation'] and assessments:
+                    assessments[-1][0] = max(-1.0, min(assessments[-1][0] * 1.25, 1.0))
+                if word['sarcasm']:
+                    assessments.append([0.0, 1.0, 1.0, 1])
+                if word['is_emoticon']:
+                    assessments.append([word['emoticon'], 1.0, 1.0, 1])
+
+        polarities = [polarity * -0.5 if sign < 0 else polarity
+                      for polarity, _, _, sign in assessments]
+        results.append((sum(polarities) / (len(assessments) or 1),
+                        sum(row[1] for row in assessments) / (len(assessments) or 1)))
+
+    return results
+
+
+# sentences the scores are checked on against TextBlob, with the contractions
+# spaCy and TextBlob split differently
+parity_cases = ["It wasn't very good.", 'It wasn\u2019t very good.', "It was n't very good.",
+                "I don't love you.", 'I do not love you.', "Don't be sad!",
+                "It isn't bad, it's not good", "I can't say I wasn't happy.",
+                "Really won't good", 'Really won\u2019t good', "You're not very happy",
+                "Y'all are very happy", "'Tis not lovely", "O'er the happy hills",
+                'Not a good day (!)', 'What a lovely day :)', 'It is not very bad!',
+                'A Drop Fell on the Apple Tree -', 'The Birds jocoser sung -',
+                'Myself Conjectured were they Pearls -']
+
+
+def check_parity(texts):
+    import spacy
+    from textblob import TextBlob
+
+    nlp = spacy.blank('en')
+    mismatches = []
+    for text in texts:
+        doc = nlp(text)
+        scores = sentence_scores(doc, [(0, len(doc))])[0]
+        expected = tuple(TextBlob(text).sentiment)
+        if not np.allclose(scores, expected):
+            mismatches.append(f'{text!r}: {scores} instead of {expected}')
+
+        for token, polarity in zip(doc, token_polarity(doc).tolist()):
+            expected = TextBlob(token.text).sentiment.polarity
+            if not np.isclose(polarity, expected):
+                mismatches.append(f'{token.text!r} in {text!r}: {polarity} instead of {expected}')
+
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check the scores against TextBlob on sentences with contractions '
+        'and the other cases the port handles, and on every line of the given files.')
+    parser.add_argument('files', nargs='*')
+    args = parser.parse_args(argv)
+
+    texts = list(parity_cases)
+    for name in args.files:
+        with open(name, encoding='utf-8') as lines:
+            texts.extend(line.strip() for line in lines if line.strip())
+
+    mismatches = check_parity(texts)
+    for mismatch in mismatches:
+        print(mismatch)
+    print(f'{len(texts)} texts, {len(mismatches)} mismatches', file=sys.stderr)
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+import annotation_store
+import instrumentation
+import memory_cache
+import store_backend
+import workers
+from language_processing import analyze, analyze_batch, excluded, layer_names
+from models import load_model
+
+# main.py fetches its analyses from this address instead of loading a model,
+# so several frontends can share the warm pipeline of one service
+service_url = os.environ.get('TEXTGLYPHS_SERVICE')
+# seconds a frontend waits for an answer before showing an error
+service_timeout = float(os.environ.get('TEXTGLYPHS_SERVICE_TIMEOUT', 60))
+
+# requests arriving within the window are parsed together
+pending = []
+pending_changed = threading.Condition()
+
+
+def collect(text, layers):
+    future = Future()
+    with pending_changed:
+        pending.append((text, layers, future))
+        pending_changed.notify()
+
+    return future.result()
+
+
+def collector(window, batch_size):
+    while True:
+        with pending_changed:
+            while not pending:
+                pending_changed.wait()
+
+        time.sleep(window)
+        with pending_changed:
+            batch = pending[:batch_size]
+            del pending[:batch_size]
+
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        layers = [layer for layer in layer_names
+                  if any(layer in requested for _, requested, _ in batch)]
+        try:
+            results = dict(zip(texts, workers.run(analyze_batch, texts, layers)))
+        except Exception:
+            # one bad text must not fail the others parsed with it
+            for text, requested, future in batch:
+                try:
+                    future.set_result(workers.run(analyze, text, requested))
+                except Exception as error:
+                    future.set_exception(error)
+            continue
+
+        for text, _, future in batch:
+            future.set_result(results[text])
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/layers':
+            self.reply(200, {'layers': layer_names})
+        else:
+            self.reply(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/analyze':
+            self.reply(404, {'error': f'unknown path {self.path}'})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            text = request['text']
+            requested = request.get('layers', layer_names)
+            if not isinstance(text, str):
+                raise TypeError('text must be a string')
+            if (not isinstance(requested, list)
+                    or not all(isinstance(layer, str) for layer in requested)):
+                raise TypeError('layers must be a list of strings')
+            unknown = [layer for layer in requested if layer not in layer_names]
+            if unknown:
+                raise ValueError(f'unknown layers {", ".join(unknown)}')
+            layers = requested
+        except (KeyError, TypeError, ValueError) as error:
+            self.reply(400, {'error': f'bad request: {error}'})
+            return
+
+        try:
+            if request.get('per_line'):
+                # verses parsed on their own are not batched with other texts
+                store = workers.run(analyze, text, layers, True)
+            else:
+                store = collect(text, layers)
+        except Exception as error:
+            self.reply(500, {'error': repr(error)})
+            return
+
+        self.reply(200, annotation_store.to_dict(store))
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    # a whole class opening the page at once must not find the door shut
+    request_queue_size = 128
+
+
+def serve(host='127.0.0.1', port=8765, window=0.01, batch_size=64):
+    load_model(exclude=excluded())
+    threading.Thread(target=collector, args=(window, batch_size), daemon=True).start()
+    server = Server((host, port), Handler)
+    print(f'analysis service on http://{host}:{server.server_port}', file=sys.stderr, flush=True)
+    server.serve_forever()
+
+
+# the client side, the functions main.py calls on its backend; each text is
+# fetched once with every layer and kept for the reruns, in the memory budget
+prefetcher = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prefetch')
+
+
+def remote_analyze(text, per_line=False):
+    store = memory_cache.get(('fetched', text, per_line))
+    if store is not None:
+        instrumentation.count('memory cache hits')
+        return store
+
+    with instrumentation.stage('service'):
+        request = Request(service_url.rstrip('/') + '/analyze',
+                          data=json.dumps({'text': text, 'layers': layer_names,
+                                           'per_line': per_line}).encode('utf-8'),
+                          headers={'Content-Type': 'application/json'})
+        try:
+            with urlopen(request, timeout=service_timeout) as response:
+                store = annotation_store.from_dict(json.load(response))
+        except (URLError, TimeoutError) as error:
+            # HTTPError is a URLError too; main.py shows the message
+            raise ConnectionError(f'the analysis service at {service_url} failed: '
+                                  f'{getattr(error, "reason", error)}') from error
+
+    return memory_cache.put(('fetched', text, per_line), store,
+                            annotation_store.memory_size(store))
+
+
+client = store_backend.build(remote_analyze, prefetcher)
+prefetch = client['prefetch']
+cancel_prefetch = client['cancel_prefetch']
+reanalyze = client['reanalyze']
+detect_ner = client['detect_ner']
+detect_pos = client['detect_pos']
+detect_quantity = client['detect_quantity']
+detect_persons = client['detect_persons']
+detect_tenses = client['detect_tenses']
+detect_sentiments = client['detect_sentiments']
+detect_subjectivity = client['detect_subjectivity']
+detect_summary = client['detect_summary']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve the annotation layers over HTTP, for main.py with '
+        'TEXTGLYPHS_SERVICE set to the printed address.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--window', type=float, default=0.01,
+                        help='seconds to wait for other requests to parse together')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='most texts parsed in one nlp.pipe call')
+    args = parser.parse_args(argv)
+
+    serve(args.host, args.port, args.window, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
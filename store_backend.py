@@ -0,0 +1,35 @@
+import instrumentation
+from language_processing import layer_names
+
+# main.py calls the same functions on whichever module gives it analyses;
+# the service client and the bundle viewer answer every filter with one store
+# holding all the layers, and differ only in how they fetch it
+
+
+def build(fetch, prefetcher=None):
+    def prefetch(text, per_line=False):
+        return [] if prefetcher is None else [prefetcher.submit(fetch, text, per_line)]
+
+    def cancel_prefetch(futures):
+        for future in futures:
+            future.cancel()
+
+    def reanalyze(previous, text):
+        # the store of the whole text already has every layer, there are no
+        # stanzas to splice
+        return {'analysis': fetch(text)}
+
+    functions = {'prefetch': prefetch, 'cancel_prefetch': cancel_prefetch,
+                 'reanalyze': reanalyze}
+    for layer in layer_names + ['summary']:
+        functions[f'detect_{layer}'] = detector(fetch, f'detect_{layer}')
+    return functions
+
+
+def detector(fetch, name):
+    # the filters only differ in the stage their time is recorded under
+    def detect(text, per_line=False):
+        return fetch(text, per_line)
+
+    detect.__name__ = detect.__qualname__ = name
+    return instrumentation.timed(detect)
@@ -1,11 +1,137 @@
+import sys
+from collections import Counter
+from functools import lru_cache
+import numpy as np
+import pandas as pd
 import streamlit as st
-from spacy import displacy
+from spacy.displacy.render import DEFAULT_ENTITY_COLOR, DEFAULT_LABEL_COLORS
 from spacy.displacy.templates import TPL_ENT as default_template 
+import instrumentation
+import memory_cache
+from language_processing import (label_counts, layer_verses, stanza_counts, verse_counts,
+                                 verse_texts)
 
-wrapper = """<div style="background: rgba(255, 255, 255, 0.3); op overflow-x: auto; border: 0px; border-radius: 0.7rem; padding-left: 3em">{}</div>"""
+wrapper = """<div style="background: rgba(255, 255, 255, 0.3); op overflow-x: auto; border: 0px; border-radius: 0.7rem; padding-left: 3em; margin-bottom: 1rem">{}</div>"""
 style = """<style>mark.entity { display: inline-block }</style>"""
+entities = """<div class="entities" style="line-height: 2.5; direction: ltr">{}</div>"""
+escapes = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'})
 
-def display_ner(spacy_text, opacity):
+pos_categories = {
+    'nouns and pronouns': ['PROPN', 'NOUN', 'PRON'],
+    'verbs and auxiliaries': ['VERB', 'AUX'],
+    'adjectives, adverbs and adposition': ['ADJ', 'ADV', 'ADP'],
+    'conjuctions and particles': ['CONJ', 'SCONJ', 'CCONJ', 'PART'],
+    'determiners': ['DET'],
+    'interjections': ['INTJ'],
+    'punctuaction and extra spaces': ['PUNCT', 'SPACE'],
+    'numerals and special characters': ['NUM', 'SYM']
+}
+
+# whole rendered poems, keyed by document, layer and every styling input, and
+# the escaped verse fragments they are built from, so moving the opacity
+# slider only joins precompiled templates around already escaped text; they
+# are kept with the analyses, in the memory budget
+part_bytes = 80
+
+
+def remember(kind, key, value, size):
+    # results of documents without a key are never looked up again
+    if key[0] is None:
+        return value
+
+    return memory_cache.put((kind,) + key, value, size)
+
+
+def recall(kind, key):
+    if key[0] is None:
+        return None
+
+    return memory_cache.get((kind,) + key)
+
+
+def segments_size(segments):
+    return sum(part_bytes + len(part if isinstance(part, str) else part[1])
+               for parts in segments for part in parts)
+
+
+def verse_segments(spacy_text, layer, window=None):
+    key = (spacy_text.get('key'), layer, window)
+    segments = recall('segments', key)
+    if segments is not None:
+        return segments
+
+    segments = []
+    for verse in layer_verses(spacy_text, layer, window):
+        text = verse['text']
+        parts = []
+        offset = 0
+        for ent in verse['ents']:
+            parts.append(text[offset:ent['start']].translate(escapes))
+            parts.append((ent['label'], text[ent['start']:ent['end']].translate(escapes)))
+            offset = ent['end']
+        parts.append(text[offset:].translate(escapes))
+        segments.append(parts)
+
+    return remember('segments', key, segments, segments_size(segments))
+
+
+@lru_cache(maxsize=4096)
+def entity_template(template, label, color, replacements):
+    html = template.replace('\n', ' ').replace('{text}', '\0').format(
+        label=label, bg=color, kb_link='')
+    for old, new in replacements:
+        html = html.replace(old, new)
+
+    return tuple(html.split('\0'))
+
+
+def render_layer(spacy_text, layer, template=default_template, colors={},
+                 ents=None, replacements=(), window=None):
+    colors = dict(DEFAULT_LABEL_COLORS, **colors)
+    colors = {label.upper(): color for label, color in colors.items()}
+    if ents is not None:
+        ents = frozenset(ent.upper() for ent in ents)
+    replacements = tuple(replacements)
+
+    key = (spacy_text.get('key'), layer, template, tuple(sorted(colors.items())),
+           ents, replacements, window)
+    html = recall('render', key)
+    if html is not None:
+        instrumentation.count('render cache hits')
+        return html
+
+    instrumentation.count('render cache misses')
+    with instrumentation.stage('render'):
+        html = join_verses(spacy_text, layer, template, colors, ents, replacements, window)
+
+    return remember('render', key, html, sys.getsizeof(html))
+
+
+def join_verses(spacy_text, layer, template, colors, ents, replacements, window):
+    verses = []
+    for parts in verse_segments(spacy_text, layer, window):
+        markup = []
+        for part in parts:
+            if isinstance(part, str):
+                markup.append(part)
+            elif ents is None or part[0].upper() in ents:
+                label, text = part
+                color = colors.get(label.upper(), DEFAULT_ENTITY_COLOR)
+                markup.append(text.join(entity_template(template, label, color, replacements)))
+            else:
+                markup.append(part[1])
+        verses.append(wrapper.format(entities.format(''.join(markup))))
+
+    return style + ''.join(verses)
+
+
+def display_verses(html):
+    instrumentation.note(html=len(html))
+    with instrumentation.stage('transport'):
+        st.write(html, unsafe_allow_html=True)
+
+
+def render_ner(spacy_text, opacity, window=None):
     template = default_template
     
     if opacity < 3:
@@ -23,15 +149,12 @@ def display_ner(spacy_text, opacity):
     if opacity == 0:
         template = template[:template.find('<span style=')] + '</mark>'
     
-    for verse in spacy_text['lines']:
-        html = displacy.render(
-            verse,
-            style='ent',
-            options={'template': template}
-            )
+    return render_layer(spacy_text, 'ner', template, window=window)
 
-        html = html.replace('\n', ' ')
-        st.write(f'{style}{wrapper.format(html)}', unsafe_allow_html=True)
+
+@instrumentation.timed
+def display_ner(spacy_text, opacity, window=None):
+    display_verses(render_ner(spacy_text, opacity, window))
 
     st.sidebar.markdown('##### 3. Interpret the poem with the annotations:')
     st.sidebar.info('**Note:** This model extracts key information. It is trained mostly on '
@@ -49,7 +172,7 @@ def display_ner(spacy_text, opacity):
             'this mean for us?')
     
     
-def display_pos(spacy_text, pos_style, opacity):
+def render_pos(spacy_text, pos_style, opacity, pos_selection=None, window=None):
 
     alpha = str(opacity / 10)
 
@@ -81,63 +204,51 @@ def display_pos(spacy_text, pos_style, opacity):
     pos_options = {"colors": pos_colors, 'template': pos_pattern_styling}
 
     if pos_style == 'search':
-        pos_categories = {
-            'nouns and pronouns': ['PROPN', 'NOUN', 'PRON'],
-            'verbs and auxiliaries': ['VERB', 'AUX'],
-            'adjectives, adverbs and adposition': ['ADJ', 'ADV', 'ADP'],
-            'conjuctions and particles': ['CONJ', 'SCONJ', 'CCONJ', 'PART'],
-            'determiners': ['DET'],
-            'interjections': ['INTJ'],
-            'punctuaction and extra spaces': ['PUNCT', 'SPACE'],
-            'numerals and special characters': ['NUM', 'SYM']
-            }
-        
+        if opacity >= 5:
+            label_type = '{label}'
+        elif opacity < 3:
+            label_type = ''
+        else:
+            label_type = '{label[0]}'
+    
+        pos_search_styling = """<mark class="entity" style="background: linear-gradient(90deg, transparent """+str(100 - opacity*15)+"""%, {bg}); padding: 0.5em 0.4em; margin: 0 0.25em; line-height: 1em; border-radius: 0.2em; box-decoration-break: clone; -webkit-box-decoration-break: clone">
+        <span style="font-weight: bold;">{text}</span><span style="font-size: """+str(0.5 + opacity/10/2)+"""em; font-family: sans-serif; color: white; margin-left: """+str(opacity/10/2)+"""rem;">"""+label_type+"""</span></mark>"""
+            
+        pos_options.update({'template': pos_search_styling})
+        pos_options.update({'ents': pos_selection})
+
+    return render_layer(spacy_text, 'pos', pos_options['template'], pos_options['colors'],
+                        pos_options.get('ents'), window=window)
+
+
+@instrumentation.timed
+def display_pos(spacy_text, pos_style, opacity, window=None):
+    pos_selection = None
+
+    if pos_style == 'search':
+        pos_counts = label_counts(spacy_text, 'pos')
         search_bar = st.sidebar.selectbox('Select the parts to focus on:',
                                             options=pos_categories,
                                             format_func=lambda option: option +
-                                            ' ' + str(sum([1 for pos
-                                                in spacy_text['text'].ents
-                                            if pos.label_ in pos_categories[option]])))
+                                            ' ' + str(sum(pos_counts.get(pos, 0)
+                                                for pos in pos_categories[option])))
         
         pos_selection = pos_categories[search_bar]
         
-        if sum([1 for pos in spacy_text['text'].ents if pos.label_
-                in pos_categories[search_bar]]) == 0:
+        if sum(pos_counts.get(pos, 0) for pos in pos_categories[search_bar]) == 0:
             st.sidebar.warning('unvalid selection, no text to annotate found')
         
         if st.sidebar.checkbox('advanced selection:'):
-            all_pos = set([pos.label_ for pos in spacy_text['text'].ents])
+            all_pos = set(pos_counts)
             extra_bar = st.sidebar.multiselect('Select the parts to focus on:',
                         all_pos,
                         default=list(set(pos_categories[search_bar])
                                      .intersection(all_pos)))
 
             pos_selection = extra_bar
-        
-        
-        if opacity >= 5:
-            label_type = '{label}'
-        elif opacity < 3:
-            label_type = ''
-        else:
-            label_type = '{label[0]}'
-    
-        pos_search_styling = """<mark class="entity" style="background: linear-gradient(90deg, transparent """+str(100 - opacity*15)+"""%, {bg}); padding: 0.5em 0.4em; margin: 0 0.25em; line-height: 1em; border-radius: 0.2em; box-decoration-break: clone; -webkit-box-decoration-break: clone">
-        <span style="font-weight: bold;">{text}</span><span style="font-size: """+str(0.5 + opacity/10/2)+"""em; font-family: sans-serif; color: white; margin-left: """+str(opacity/10/2)+"""rem;">"""+label_type+"""</span></mark>"""
-            
-        pos_options.update({'template': pos_search_styling})
-        pos_options.update({'ents': pos_selection})
 
-    for verse in spacy_text['lines']:
-        html = displacy.render(
-            verse,
-            style='ent',
-            options=pos_options
-        )
+    display_verses(render_pos(spacy_text, pos_style, opacity, pos_selection, window))
 
-        html = html.replace('\n', ' ')
-        st.write(f'{style}{wrapper.format(html)}', unsafe_allow_html=True)
-        
     st.sidebar.markdown('##### 3. Interpret the poem with the annotations:')
     st.sidebar.info('**Note:** This model is trained mostly on '
             'texts related to news, but also on conversations, weblogs, '
@@ -152,7 +263,7 @@ def display_pos(spacy_text, pos_style, opacity):
                     'text structure or conjuctions to form an argumentation')
         
         
-def display_quantity(spacy_text, opacity):
+def render_quantity(spacy_text, opacity, window=None):
     template = default_template.replace('border-radius: 0.35',
             'border-radius: 0').replace('padding: 0.45em 0.6em', 'padding: 0.1em')
     
@@ -163,20 +274,18 @@ def display_quantity(spacy_text, opacity):
                     'PLUR': f' transparent; border-bottom: {str(opacity / 5 / 3.5)}em double hsl(55, 95%, 50%)'}
   
     
-    for verse in spacy_text['lines']:
-        html = displacy.render(
-            verse,
-            style='ent',
-            options={'colors': quantity_colors, 'template': template}
-            )
-  
-        
-        html = html.replace('\n', ' ')
-        
-        if opacity >= 4 and opacity < 8:
-            html = html.replace('SING', 'SG').replace('PLUR', 'PL')
-            
-        st.write(f'{style}{wrapper.format(html)}', unsafe_allow_html=True)
+    replacements = []
+    if opacity >= 4 and opacity < 8:
+        replacements = [('SING', 'SG'), ('PLUR', 'PL')]
+
+    return render_layer(spacy_text, 'quantity', template, quantity_colors,
+                        replacements=replacements, window=window)
+
+
+@instrumentation.timed
+def display_quantity(spacy_text, opacity, window=None):
+    display_verses(render_quantity(spacy_text, opacity, window))
+
         
     st.sidebar.markdown('##### 3. Interpret the poem with the annotations:')
     st.sidebar.info('**Tips for interpretation:** a lot of singulars could '
@@ -184,7 +293,7 @@ def display_quantity(spacy_text, opacity):
                     ' richness')
         
     
-def display_persons(spacy_text, opacity):
+def render_persons(spacy_text, opacity, window=None):
     template = default_template.replace('padding: 0.45em 0.6em', 'padding: 0.3em'
                             ).replace(' margin-left: 0.5rem', ' margin-left: 0.2rem')
     
@@ -203,18 +312,18 @@ def display_persons(spacy_text, opacity):
                     '3 PLUR': 'linear-gradient(0deg, hsla(310, 100%, 50%, '+ alpha +') 15%, transparent 20%)',
                     '2': 'linear-gradient(0deg, hsla(310, 0%, 50%, '+ alpha +') 15%, transparent 20%)'}
     
-    for verse in spacy_text['lines']:
-        html = displacy.render(
-            verse,
-            style='ent',
-            options={'colors': pers_colors, 'template': template}
-            )
-        
-        if opacity >= 3 and opacity < 8:
-            html = html.replace('SING', 'SG').replace('PLUR', 'PL')
-        
-        html = html.replace('\n', ' ')
-        st.write(f'{style}{wrapper.format(html)}', unsafe_allow_html=True)
+    replacements = []
+    if opacity >= 3 and opacity < 8:
+        replacements = [('SING', 'SG'), ('PLUR', 'PL')]
+
+    return render_layer(spacy_text, 'persons', template, pers_colors,
+                        replacements=replacements, window=window)
+
+
+@instrumentation.timed
+def display_persons(spacy_text, opacity, window=None):
+    display_verses(render_persons(spacy_text, opacity, window))
+
         
     st.sidebar.markdown('##### 3. Interpret the poem with the annotations:')
     st.sidebar.info('**Tips for interpretation:** look at who are the actors '
@@ -223,7 +332,7 @@ def display_persons(spacy_text, opacity):
                     'more about hemselves or about others?')
         
         
-def display_tenses(spacy_text, opacity):
+def render_tenses(spacy_text, opacity, window=None):
     template = default_template.replace('padding: 0.45em 0.6em; margin: 0 0.25em;',
                                         'padding: 0.45em 0.6em; margin: 0;')
     
@@ -243,20 +352,20 @@ def display_tenses(spacy_text, opacity):
                    'PRESENT': 'linear-gradient(0deg, yellow, transparent)'}
     
 
-    for verse in spacy_text['lines']:
-        html = displacy.render(
-            verse,
-            style='ent',
-            options={'colors': time_colors, 'template':
-                     template.replace('border-radius: 0.35',
-                        'border-radius: 0.9').replace('{text}', '<span class="{label}">{text}</span>')}
-            )
-
-        html = html.replace('\n', ' ')
-        html = html.replace('class="OTHER"', 'class="OTHER" style="font-style: italic;"')
-        html = html.replace('class="PAST"', """class="OTHER" style="display: inline-block; -webkit-transform: skew(10deg,0deg); -moz-transform: skew(10deg,0deg); transform: skew(10deg,0deg);" """)
-        
-        st.write(f'{style}{wrapper.format(html)}', unsafe_allow_html=True)
+    template = template.replace('border-radius: 0.35',
+        'border-radius: 0.9').replace('{text}', '<span class="{label}">{text}</span>')
+
+    replacements = [('class="OTHER"', 'class="OTHER" style="font-style: italic;"'),
+                    ('class="PAST"', """class="OTHER" style="display: inline-block; -webkit-transform: skew(10deg,0deg); -moz-transform: skew(10deg,0deg); transform: skew(10deg,0deg);" """)]
+
+    return render_layer(spacy_text, 'tenses', template, time_colors,
+                        replacements=replacements, window=window)
+
+
+@instrumentation.timed
+def display_tenses(spacy_text, opacity, window=None):
+    display_verses(render_tenses(spacy_text, opacity, window))
+
     
     st.sidebar.markdown('##### 3. Interpret the poem with the annotations:')
     st.sidebar.info('**Tips for interpretation:** when to things happen in the'
@@ -264,7 +373,7 @@ def display_tenses(spacy_text, opacity):
                     'reminesences of the past, or plans the future?')
         
         
-def display_sentiments(spacy_text, opacity):
+def render_sentiments(spacy_text, opacity, window=None):
     template = default_template.replace('padding: 0.45em 0.6em', 'padding: 0.75em'
                             ).replace(' margin-left: 0.5rem', ' margin-left: 0.2rem'
                             ).replace('border-radius: 0.35em', 'border-radius: 1em')
@@ -285,15 +394,13 @@ def display_sentiments(spacy_text, opacity):
             sentiments_colors.update({str(round(i/10, 1)): 
                                     f"linear-gradient(0deg, transparent, hsla({40 - abs(i) * 4}, 100%, {80 - abs(i) * 3}%, {alpha}) {30 + opacity * 4}%, transparent {30 + opacity * 4}%)"})
         
-    for verse in spacy_text['lines']:
-        html = displacy.render(
-            verse,
-            style='ent',
-            options={'colors': sentiments_colors, 'template': template}
-            )
-        
-        html = html.replace('\n', ' ')
-        st.write(f'{style}{wrapper.format(html)}', unsafe_allow_html=True)
+    return render_layer(spacy_text, 'sentiments', template, sentiments_colors,
+                        window=window)
+
+
+@instrumentation.timed
+def display_sentiments(spacy_text, opacity, window=None):
+    display_verses(render_sentiments(spacy_text, opacity, window))
 
     st.sidebar.markdown('##### 3. Interpret the poem with the annotations:')
     st.sidebar.info('**Note:** This model is trained mostly on movie reviews, '
@@ -308,7 +415,7 @@ def display_sentiments(spacy_text, opacity):
                     " They it's maybe an hyperbole or euphemisms then.")
         
         
-def display_subjectivity(spacy_text, opacity):
+def render_subjectivity(spacy_text, opacity, window=None):
     alpha = str(0.2 + opacity / 5)
     
     subjectivity_colors = {}
@@ -317,15 +424,14 @@ def display_subjectivity(spacy_text, opacity):
         subjectivity_colors.update({str(round(i/10, 1)):
                                 f"radial-gradient(hsla({250 + i * 5}, 100%, {100 - i * 4}%, {alpha}), transparent {65 + opacity * 3}%)"})
 
-    for verse in spacy_text['lines']:
-        html = displacy.render(
-            verse,
-            style='ent',
-            options={'colors': subjectivity_colors}
-            )
-        
-        html = html.replace('\n', ' ')
-        st.write(f'{style}{wrapper.format(html)}', unsafe_allow_html=True)
+    return render_layer(spacy_text, 'subjectivity', colors=subjectivity_colors,
+                        window=window)
+
+
+@instrumentation.timed
+def display_subjectivity(spacy_text, opacity, window=None):
+    display_verses(render_subjectivity(spacy_text, opacity, window))
+
         
     st.sidebar.markdown('##### 3. Interpret the poem with the annotations:')
     st.sidebar.info('**Note:** This model is trained mostly on movie reviews, '
@@ -334,4 +440,110 @@ def display_subjectivity(spacy_text, opacity):
 
     st.sidebar.info('**Tips for interpretation:** This filter behaves weirdly.'
                     ' Why does it detect phrases as being more opinionated? '
-                    'Are they more personal? Do they state strong beliefs?')
\ No newline at end of file
+                    'Are they more personal? Do they state strong beliefs?')
+
+@instrumentation.timed
+def display_summary(spacy_text):
+    for layer in ('tenses', 'persons'):
+        labels, counts = stanza_counts(spacy_text, layer)
+        st.markdown(f'##### {layer.capitalize()} in each stanza')
+        if labels:
+            st.bar_chart(pd.DataFrame(counts, columns=labels,
+                                      index=pd.RangeIndex(1, len(counts) + 1, name='stanza')))
+        else:
+            st.info(f'No {layer} were found in this text.')
+
+    labels, counts = stanza_counts(spacy_text, 'sentiments')
+    scores = np.array([float(label) for label in labels])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        polarity = counts @ scores / counts.sum(axis=1)
+    st.markdown('##### Mean polarity of the words in each stanza')
+    st.line_chart(pd.DataFrame({'polarity': polarity},
+                               index=pd.RangeIndex(1, len(counts) + 1, name='stanza')))
+
+    st.sidebar.markdown('##### 3. Interpret the poem with the annotations:')
+    for layer in ('tenses', 'persons'):
+        counts = Counter(label_counts(spacy_text, layer))
+        st.sidebar.caption(f'{layer.capitalize()} in the whole text: ' +
+                           (', '.join(f'{label} {count}' for label, count
+                                      in counts.most_common()) or 'none'))
+    st.sidebar.info('**Tips for interpretation:** Does the poem move from the past to '
+                    'the present, or from one person to another? Do the changes of '
+                    'tone follow the stanzas?')
+
+
+# every filter with its default styling, for pages rendered outside the app
+renderers = {'ner': render_ner,
+             'pos': lambda spacy_text, opacity, window=None:
+                 render_pos(spacy_text, 'pattern', opacity, window=window),
+             'quantity': render_quantity,
+             'persons': render_persons,
+             'tenses': render_tenses,
+             'sentiments': render_sentiments,
+             'subjectivity': render_subjectivity}
+
+
+@instrumentation.timed
+def display_hits(results, opacity):
+    if not results['count']:
+        st.warning('No verse of the corpus matches this query.')
+        return
+
+    shown = sum(len(hit['lines']) for hit in results['texts'])
+    st.sidebar.caption(f'{results["count"]} matching verses, the first {shown} are shown')
+
+    render = renderers[results['layer']]
+    for hit in results['texts']:
+        st.markdown(f'##### {hit["id"]}')
+        display_verses(''.join(render(hit['store'], opacity, (line, line + 1))
+                               for line in hit['lines']))
+
+
+def page_bounds(spacy_text, page_lines):
+    # pages end on a stanza break once they hold page_lines verses, and
+    # stanzas longer than a page are cut
+    key = (spacy_text.get('key'), 'pages', page_lines)
+    pages = recall('pages', key)
+    if pages is not None:
+        return pages
+
+    pages = []
+    start = 0
+    texts = verse_texts(spacy_text)
+    for line, text in enumerate(texts):
+        length = line + 1 - start
+        if length >= page_lines or (not text.strip() and length >= page_lines // 2):
+            pages.append((start, line + 1))
+            start = line + 1
+    if start < len(texts) or not pages:
+        pages.append((start, len(texts)))
+
+    return remember('pages', key, pages, part_bytes * (len(pages) + 1))
+
+
+def page_counts(spacy_text, layer, pages):
+    counts = verse_counts(spacy_text, layer)
+    return [int(counts[start:stop].sum()) for start, stop in pages]
+
+
+def display_page_labels(spacy_text, layer, window):
+    labels = Counter(label_counts(spacy_text, layer, window))
+    st.sidebar.caption('On this page: ' + ', '.join(f'{label} {count}' for label, count
+                                                   in labels.most_common()))
+
+
+def display_metrics(metrics):
+    lines = [f'{"  " * stage["depth"] + stage["stage"]:<30}{stage["seconds"] * 1000:9.1f} ms'
+             for stage in metrics['stages']]
+    lines.append(f'{"whole run":<30}{metrics["total"] * 1000:9.1f} ms')
+    lines.append('')
+    lines.extend(f'{name:<30}{value:>9}' for name, value
+                 in list(metrics['counters'].items()) + list(metrics['sizes'].items()))
+    lines.extend(f'{"cold start " + stage:<30}{seconds:>9.2f} s'
+                 for stage, seconds in metrics['startup'].items())
+    for name, values in metrics['process'].items():
+        lines.append('')
+        lines.extend(f'{name + " " + key:<30}{value:>9}' for key, value in values.items())
+
+    with st.sidebar.expander('Debug: timings of this run'):
+        st.text('\n'.join(lines))
@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future
+
+import instrumentation
+
+# analyses run on a fixed number of threads shared by every session of the
+# process; each session has its own queue and the threads take turns between
+# sessions, so one long text or a burst of prefetches cannot hold up the rest
+max_in_flight = int(os.environ.get('TEXTGLYPHS_WORKERS', 2))
+session_queue = int(os.environ.get('TEXTGLYPHS_SESSION_QUEUE', 8))
+
+queues = OrderedDict()
+queues_changed = threading.Condition()
+threads = []
+local = threading.local()
+
+stats = Counter()
+
+
+def session_id():
+    try:
+        from streamlit.scriptrunner import get_script_run_ctx
+    except ImportError:
+        return None
+
+    context = get_script_run_ctx()
+    return context.session_id if context else None
+
+
+def start_threads():
+    while len(threads) < max_in_flight:
+        thread = threading.Thread(target=work, name=f'analysis-{len(threads)}', daemon=True)
+        threads.append(thread)
+        thread.start()
+
+
+def submit(function, *args, session=None, urgent=False):
+    future = Future()
+    job = {'future': future, 'call': (function, args), 'urgent': urgent,
+           'run': instrumentation.current() if urgent else None,
+           'queued': time.perf_counter()}
+    session = session_id() if session is None else session
+
+    with queues_changed:
+        start_threads()
+        queue = queues.setdefault(session, deque())
+        if urgent:
+            # what the session is waiting for goes before its prefetches
+            queue.appendleft(job)
+        else:
+            queue.append(job)
+        stats['submitted'] += 1
+
+        # a session over its limit loses its oldest background job
+        while len(queue) > session_queue:
+            oldest = next((job for job in queue if not job['urgent']), None)
+            if oldest is None:
+                break
+            queue.remove(oldest)
+            oldest['future'].cancel()
+            stats['dropped'] += 1
+
+        queues_changed.notify()
+
+    return future
+
+
+def run(function, *args):
+    # analyses started from a worker, like a prefetch, never wait for another
+    # worker, which could be the one waiting
+    if getattr(local, 'working', False):
+        return function(*args)
+
+    instrumentation.note(waiting=waiting())
+    return submit(function, *args, urgent=True).result()
+
+
+def waiting():
+    with queues_changed:
+        return sum(len(queue) for queue in queues.values())
+
+
+def summary():
+    return dict(sorted(stats.items()), waiting=waiting(), threads=len(threads))
+
+
+def next_job():
+    with queues_changed:
+        while not queues:
+            queues_changed.wait()
+
+        # the session served first goes to the back of the line
+        session, queue = next(iter(queues.items()))
+        job = queue.popleft()
+        if queue:
+            queues.move_to_end(session)
+        else:
+            del queues[session]
+
+        return job
+
+
+def work():
+    local.working = True
+    while True:
+        job = next_job()
+        future = job['future']
+        if not future.set_running_or_notify_cancel():
+            continue
+
+        function, args = job['call']
+        with instrumentation.recording(job['run']):
+            instrumentation.record('queue', time.perf_counter() - job['queued'])
+            try:
+                result = function(*args)
+            except BaseException as error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+instrumentation.watch('workers', summary)